@@ -0,0 +1,124 @@
+'''admission - concurrency limits for classes of requests
+
+Each AdmissionGate admits up to `limit` concurrent holders. Up to `queue`
+further callers may wait (for at most `timeout` seconds) for a slot; anyone
+beyond that is turned away immediately so the caller can answer 503 instead
+of tying up a worker thread indefinitely.
+'''
+
+import threading
+import time
+
+class AdmissionGate(object):
+    def __init__(self, name, limit, queue=0, timeout=0):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def acquire(self):
+        '''Returns True if a slot was obtained, False if the caller was shed'''
+        with self._cond:
+            if self.active < self.limit:
+                return self._admit()
+            if self.waiting >= self.queue or self.timeout <= 0:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                deadline = time.time() + self.timeout
+                while self.active >= self.limit:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    self._cond.wait(remaining)
+                return self._admit()
+            finally:
+                self.waiting -= 1
+
+    def _admit(self):
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {'limit':self.limit, 'queue':self.queue,
+                    'active':self.active, 'waiting':self.waiting,
+                    'admitted':self.admitted, 'rejected':self.rejected}
+
+
+class _Releaser(object):
+    # calls release exactly once, however many times the body is closed
+    def __init__(self, release):
+        self._release = release
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            release, self._release = self._release, None
+        if release:
+            release()
+
+
+class GuardedFile(object):
+    '''File proxy that releases its slot when closed.
+    Everything else (read, fileno, ...) is delegated, so servers can still
+    hand the file to wsgi.file_wrapper / sendfile.
+    '''
+    def __init__(self, fobj, release):
+        self._fobj = fobj
+        self._release = _Releaser(release)
+
+    def __getattr__(self, attr):
+        return getattr(self._fobj, attr)
+
+    def close(self):
+        try:
+            self._fobj.close()
+        finally:
+            self._release()
+
+
+class GuardedIter(object):
+    '''Iterator proxy that releases its slot when exhausted or closed'''
+    def __init__(self, body, release):
+        self._body = body
+        self._release = _Releaser(release)
+
+    def __iter__(self):
+        try:
+            for chunk in self._body:
+                yield chunk
+        finally:
+            self._release()
+
+    def close(self):
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._release()
+
+
+def guard_body(body, release):
+    '''Wraps a response body so that release() runs once it is done with.
+    Bodies that are already complete (strings) release straight away.
+    '''
+    if hasattr(body, 'read'):
+        return GuardedFile(body, release)
+    if isinstance(body, basestring) or body is None:
+        release()
+        return body
+    return GuardedIter(body, release)
@@ -0,0 +1,275 @@
+'''analytics - install and download counts per app and build
+
+Requests only add to counters in memory, each thread in its own table, so
+the hot paths never touch the database or contend with each other. A
+background thread collects the tables every few seconds and adds them to a
+SQLite file in one transaction, as rows of counts per time bucket, app and
+build, which top() sums over a window.
+'''
+
+import atexit
+import sqlite3
+import threading
+import time
+
+# installs are manifest requests, the others ipa downloads; unknown are the
+# downloads the server sent without showing how much of them went
+EVENTS = ('installs', 'started', 'completed', 'resumed', 'bytes', 'unknown')
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS downloads (
+    bucket INTEGER NOT NULL, app TEXT NOT NULL, build TEXT NOT NULL,
+    %s,
+    PRIMARY KEY (bucket, app, build))''' % ',\n    '.join(
+        '%s INTEGER NOT NULL DEFAULT 0' % event for event in EVENTS)
+
+COLUMN = 'ALTER TABLE downloads ADD COLUMN %s INTEGER NOT NULL DEFAULT 0'
+
+INSERT = 'INSERT OR IGNORE INTO downloads (bucket, app, build) VALUES (?, ?, ?)'
+UPDATE = 'UPDATE downloads SET %s WHERE bucket = ? AND app = ? AND build = ?' % \
+    ', '.join('%s = %s + ?' % (event, event) for event in EVENTS)
+
+def _text(value):
+    # sqlite wants unicode for TEXT; app names are the bytes os.listdir gives
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+def _merge(into, counts):
+    for key, row in counts.items():
+        total = into.get(key)
+        if total is None:
+            into[key] = row
+        else:
+            for i, n in enumerate(row):
+                total[i] += n
+
+class _Counted(object):
+    def __init__(self, body, length, done):
+        self._body = body
+        self._length = length
+        self._done = done
+        self._sent = 0
+
+    def _outcome(self):
+        return self._sent, self._sent >= self._length
+
+    def close(self):
+        outcome = self._outcome()
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            done, self._done = self._done, None
+            if done:
+                done(*outcome)
+
+
+class _CountedFile(_Counted):
+    # everything but close is the file's own (fileno too), so servers can
+    # still hand it to wsgi.file_wrapper and sendfile. What was sent is how
+    # far the file was read. A server that sent it without moving the file
+    # position (mod_wsgi's sendfile with an offset) leaves no trace of how
+    # much went, so the outcome is unknown
+    def __init__(self, body, length, done):
+        _Counted.__init__(self, body, length, done)
+        self._start = body.tell()
+
+    def __getattr__(self, attr):
+        return getattr(self._body, attr)
+
+    def _outcome(self):
+        try:
+            moved = self._body.tell() - self._start
+        except (IOError, ValueError):
+            moved = 0 # closed by the server
+        if moved <= 0 and self._length:
+            return None, None
+        self._sent = min(moved, self._length)
+        return _Counted._outcome(self)
+
+
+class _FileChunks(object):
+    # a binary file as an iterable of blocks, rather than of lines
+    def __init__(self, body, size=64*1024):
+        self._body = body
+        self._size = size
+
+    def __iter__(self):
+        return iter(lambda: self._body.read(self._size), '')
+
+    def close(self):
+        self._body.close()
+
+
+class _CountedIter(_Counted):
+    def __iter__(self):
+        for chunk in self._body:
+            self._sent += len(chunk)
+            yield chunk
+
+
+def counted(body, length, done, sendfile=True):
+    '''Returns body wrapped so that done(sent, completed) is called when the
+    server closes it, with the bytes it took and whether that was all length
+    of them, or both None if a file was sent without a sign of how much.
+    Without sendfile, files are handed to the server in blocks, so that
+    every transfer is measured but none can use sendfile.'''
+    if hasattr(body, 'read'):
+        if not sendfile:
+            return _CountedIter(_FileChunks(body), length, done)
+        return _CountedFile(body, length, done)
+    return _CountedIter(body, length, done)
+
+class _Table(object):
+    '''The counters of one thread, {(bucket, app, build):[count per event]}'''
+    def __init__(self):
+        self.counts = {}
+        self.thread = threading.current_thread()
+        # only ever contended by the flusher swapping counts out
+        self.lock = threading.Lock()
+
+
+class Analytics(object):
+    def __init__(self, path=None, bucket=3600):
+        '''
+        Param path is the SQLite file the counts are written to; without
+            one, nothing is counted.
+        Param bucket is the granularity, in seconds, counts are kept at.
+        '''
+        self.path = path
+        self.bucket = bucket
+        self.last_flush = None
+        self.last_error = None
+        self._local = threading.local()
+        self._tables = []
+        self._unwritten = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._thread = None
+
+    def enabled(self):
+        return bool(self.path)
+
+    def _table(self):
+        table = getattr(self._local, 'table', None)
+        if table is None:
+            table = self._local.table = _Table()
+            with self._lock:
+                self._tables.append(table)
+        return table
+
+    def count(self, app, build, **counts):
+        '''Adds to the counters of an app's build, e.g. started=1'''
+        if not self.path:
+            return
+        key = (int(time.time()) // self.bucket * self.bucket, _text(app), _text(build or ''))
+        table = self._table()
+        with table.lock:
+            row = table.counts.get(key)
+            if row is None:
+                row = table.counts[key] = [0]*len(EVENTS)
+            for event, n in counts.items():
+                row[EVENTS.index(event)] += n
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute(SCHEMA)
+        # databases made before an event was counted lack its column
+        columns = set(row[1] for row in db.execute('PRAGMA table_info(downloads)'))
+        for event in EVENTS:
+            if event not in columns:
+                try:
+                    db.execute(COLUMN % event)
+                except sqlite3.OperationalError:
+                    pass # added by another process meanwhile
+        return db
+
+    def flush(self):
+        '''Writes the counts gathered since the last flush in one
+        transaction. Returns the number of rows written.'''
+        with self._lock:
+            tables = self._tables[:]
+            # threads that are gone won't count any more
+            self._tables = [t for t in tables if t.thread.is_alive()]
+
+        with self._db_lock:
+            batch, self._unwritten = self._unwritten, {}
+            for table in tables:
+                with table.lock:
+                    counts, table.counts = table.counts, {}
+                _merge(batch, counts)
+            if not batch:
+                return 0
+
+            keys = batch.keys()
+            try:
+                db = self._connect()
+                try:
+                    with db:
+                        db.executemany(INSERT, keys)
+                        db.executemany(UPDATE, [batch[key] + list(key) for key in keys])
+                finally:
+                    db.close()
+            except sqlite3.Error:
+                # kept for the next flush
+                _merge(self._unwritten, batch)
+                raise
+            self.last_flush = time.time()
+            return len(keys)
+
+    def start(self, interval):
+        '''Flushes every interval seconds in a background thread'''
+        with self._lock:
+            if self._thread or not self.path:
+                return
+            self._thread = threading.Thread(target=self._run, args=(interval,))
+            self._thread.setDaemon(True)
+        # what was counted since the last flush isn't lost on shutdown
+        atexit.register(self._flush_logged)
+        self._thread.start()
+
+    def _flush_logged(self):
+        try:
+            self.flush()
+            self.last_error = None
+        except Exception, ex:
+            self.last_error = str(ex)
+            print 'analytics flush failed:', ex
+
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            self._flush_logged()
+
+    def top(self, since, until=None, by='completed', limit=10):
+        '''The builds with the most of event `by` between the times since and
+        until, as dicts of app, build and the total of each event. The
+        buckets the times fall in are counted whole.'''
+        if by not in EVENTS:
+            raise ValueError('unknown event ' + by)
+        query = 'SELECT app, build, %s FROM downloads WHERE bucket >= ?' % \
+            ', '.join('SUM(%s)' % event for event in EVENTS)
+        args = [int(since) // self.bucket * self.bucket]
+        if until is not None:
+            query += ' AND bucket <= ?'
+            args.append(int(until))
+        query += ' GROUP BY app, build ORDER BY SUM(%s) DESC, app, build LIMIT ?' % by
+        args.append(limit)
+
+        db = self._connect()
+        try:
+            rows = db.execute(query, args).fetchall()
+        finally:
+            db.close()
+        return [dict(zip(('app', 'build') + EVENTS, row)) for row in rows]
+
+    def stats(self):
+        with self._lock:
+            tables = self._tables[:]
+        pending = 0
+        for table in tables:
+            with table.lock:
+                pending += len(table.counts)
+        return {'enabled':self.enabled(), 'bucket':self.bucket,
+                'threads':len(tables), 'pending_rows':pending + len(self._unwritten),
+                'last_flush':self.last_flush, 'last_error':self.last_error}
@@ -0,0 +1,191 @@
+'''bandwidth - fair sharing of a total transfer rate between downloads
+
+A BandwidthManager owns a total rate (bytes/second) and hands each active
+download a token bucket. Rates are recomputed whenever a download starts or
+finishes, and every REALLOCATE_INTERVAL seconds while any run: clients get a
+max-min fair share of the total (never more than the optional per-client
+cap), and each client's share is split the same way between its concurrent
+downloads.
+
+Max-min fair means demand is taken into account: a download that didn't use
+its rate over the last interval (a slow client, e.g. over a VPN) is only
+given a little more than it managed, and what it leaves is shared among the
+downloads that could use more.
+'''
+
+import threading
+import time
+
+CHUNK_SIZE = 64*1024
+REALLOCATE_INTERVAL = 1.0
+# a download is limited by its own demand when it achieves less than this
+# part of its rate; it is then given what it achieved times HEADROOM (and
+# never less than MIN_RATE), so that it can speed up again
+DEMAND_LIMITED = 0.9
+HEADROOM = 1.25
+MIN_RATE = 4*1024
+
+def _max_min(total, demands):
+    '''Shares of total for the given demands (None for unlimited), as a
+    list in the same order: the smallest demands are met in full and what
+    is left is split evenly between the others'''
+    shares = [0]*len(demands)
+    order = sorted(range(len(demands)),
+                   key=lambda i: demands[i] is None and float('inf') or demands[i])
+    left = float(total)
+    for n, i in enumerate(order):
+        fair = left/(len(order) - n)
+        shares[i] = demands[i] is None and fair or min(demands[i], fair)
+        left -= shares[i]
+    return shares
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        '''Takes n tokens, sleeping for as long as the bucket is in debt'''
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now-self.stamp)*self.rate)
+            self.stamp = now
+            self.tokens -= n
+            deficit = -self.tokens
+            rate = self.rate
+        if deficit > 0:
+            time.sleep(deficit/rate)
+
+
+class Stream(object):
+    def __init__(self, manager, client, label):
+        self.manager = manager
+        self.client = client
+        self.label = label
+        self.started = time.time()
+        self.sent = 0
+        self.bucket = TokenBucket(manager.total_rate, CHUNK_SIZE)
+        # None until it is seen not to use its rate
+        self.demand = None
+        self._window = (self.started, 0)
+
+    def consume(self, n):
+        self.bucket.consume(n)
+        self.sent += n
+        self.manager.tick()
+
+    def measure(self, now):
+        '''Updates demand from what was sent since the last measure'''
+        start, sent = self._window
+        if now - start < REALLOCATE_INTERVAL/2:
+            return
+        self._window = (now, self.sent)
+        achieved = (self.sent - sent)/(now - start)
+        if achieved >= self.bucket.rate*DEMAND_LIMITED:
+            self.demand = None
+        else:
+            self.demand = max(achieved*HEADROOM, MIN_RATE)
+
+
+class ThrottledBody(object):
+    '''Iterates a response body in chunks, pacing it through a Stream'''
+    def __init__(self, body, stream):
+        self._body = body
+        self._stream = stream
+
+    def _chunks(self):
+        if hasattr(self._body, 'read'):
+            return iter(lambda: self._body.read(CHUNK_SIZE), '')
+        return iter(self._body)
+
+    def __iter__(self):
+        try:
+            for chunk in self._chunks():
+                # pace in CHUNK_SIZE pieces so large chunks from an iterable
+                # body don't turn into one long sleep
+                for i in xrange(0, len(chunk), CHUNK_SIZE):
+                    piece = chunk[i:i+CHUNK_SIZE]
+                    self._stream.consume(len(piece))
+                    yield piece
+        finally:
+            self._stream.manager.finish(self._stream)
+
+    def close(self):
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._stream.manager.finish(self._stream)
+
+
+class BandwidthManager(object):
+    def __init__(self, total_rate, per_client_rate=0):
+        self.total_rate = total_rate
+        self.per_client_rate = per_client_rate
+        self.streams = []
+        self.allocated = time.time()
+        self._lock = threading.Lock()
+
+    def enabled(self):
+        return self.total_rate > 0
+
+    def throttle(self, body, client, label=None):
+        '''Returns body wrapped so that it is paced by a new Stream'''
+        stream = Stream(self, client, label)
+        with self._lock:
+            self.streams.append(stream)
+            self._allocate()
+        return ThrottledBody(body, stream)
+
+    def finish(self, stream):
+        with self._lock:
+            if stream in self.streams:
+                self.streams.remove(stream)
+                self._allocate()
+
+    def tick(self):
+        '''Reallocates if the rates are older than REALLOCATE_INTERVAL'''
+        if time.time() - self.allocated < REALLOCATE_INTERVAL:
+            return
+        with self._lock:
+            if time.time() - self.allocated >= REALLOCATE_INTERVAL:
+                self._allocate()
+
+    def _allocate(self):
+        now = self.allocated = time.time()
+        by_client = {}
+        for stream in self.streams:
+            stream.measure(now)
+            by_client.setdefault(stream.client, []).append(stream)
+        if not by_client:
+            return
+
+        clients = by_client.values()
+        demands = []
+        for streams in clients:
+            demand = None
+            if None not in [stream.demand for stream in streams]:
+                demand = sum(stream.demand for stream in streams)
+            if self.per_client_rate:
+                demand = min(demand or self.per_client_rate, self.per_client_rate)
+            demands.append(demand)
+        for streams, share in zip(clients, _max_min(self.total_rate, demands)):
+            rates = _max_min(share, [stream.demand for stream in streams])
+            for stream, rate in zip(streams, rates):
+                stream.bucket.rate = rate
+
+    def stats(self):
+        with self._lock:
+            now = time.time()
+            streams = [{'client':s.client,
+                        'file':s.label,
+                        'rate':int(s.bucket.rate),
+                        'demand':s.demand and int(s.demand),
+                        'sent':s.sent,
+                        'elapsed':round(now-s.started, 3)} for s in self.streams]
+        return {'total_rate':self.total_rate,
+                'per_client_rate':self.per_client_rate,
+                'streams':streams}
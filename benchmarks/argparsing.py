@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+'''Command line parsing cost of optmatch as CLIs grow
+
+Synthesizes OptionMatcher subclasses with many @optmatcher and @optset
+methods, each with flags, int and float options, prefixes and aliases, and
+times process() on generated command lines for the last matcher (the worst
+case for priority order), in getopt and non-getopt modes, with and without
+GNU ordering. Prints one JSON object with, per scenario:
+
+    first_us        first process() on a new class, compiling its handlers
+    us_per_parse    median time of later process() calls
+    gc_objects      container objects left per parse with the collector off,
+                    that is, reference cycles or state kept by the matcher
+    peak_kb         peak memory allocated during a parse, when tracemalloc
+                    is available (null otherwise)
+
+Given the JSON of an earlier run, exits with status 1 if any scenario is
+more than 25% slower than it was, so it can run in CI.
+
+    python benchmarks/argparsing.py [runs] [baseline.json]
+'''
+import gc
+import json
+import os
+import platform
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from optmatch import OptionMatcher, optmatcher, optset
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# (label, matchers, common handlers, options of each kind per method)
+SIZES = [('small', 5, 1, 2), ('medium', 20, 3, 5), ('large', 60, 6, 10)]
+
+TOLERANCE = 1.25
+
+LETTERS = 'abcdefgijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+def synthesize(matchers, commons, per_kind):
+    '''Returns a new OptionMatcher subclass and the aliases to create it with.
+    Matcher i is selected with --cmdI and returns i'''
+    def parameters(tag, required):
+        pars = required[:]
+        for j in range(per_kind):
+            pars += ['f%sx%dFlag=False' % (tag, j), 'n%sx%dOptionInt=0' % (tag, j),
+                     'r%sx%dOptionFloat=0.0' % (tag, j), 'd%sx%dPrefix=None' % (tag, j)]
+        return ', '.join(['self'] + pars)
+
+    lines = ['class Tool(OptionMatcher):']
+    for c in range(commons):
+        lines += ['    @optset',
+                  '    def common%d(%s): pass' % (c, parameters('c%d' % c, []))]
+    for i in range(matchers):
+        lines += ['    @optmatcher',
+                  '    def matcher%d(%s, *rest): return %d'
+                  % (i, parameters('m%d' % i, ['cmd%dFlag' % i, 'target']), i)]
+    namespace = {'OptionMatcher':OptionMatcher, 'optmatcher':optmatcher, 'optset':optset}
+    exec '\n'.join(lines) in namespace
+    # the first options of the common handlers get short aliases
+    names = ['fc%dx%d' % (c, j) for j in range(per_kind) for c in range(commons)]
+    aliases = dict(zip(LETTERS, names))
+    return namespace['Tool'], aliases
+
+def command_line(matcher, commons, per_kind, getopt, gnu):
+    '''Returns (option prefix, argv) selecting the given matcher and giving a
+    value to all its options and to those of the common handlers'''
+    prefix = getopt and '--' or '/'
+    options = [prefix + 'cmd%d' % matcher]
+    for tag in ['m%d' % matcher] + ['c%d' % c for c in range(commons)]:
+        for j in range(per_kind):
+            options.append(prefix + 'f%sx%d' % (tag, j))
+            if getopt and not gnu:
+                # values given as separate arguments (in GNU mode, a value
+                # like this ends the options)
+                options += [prefix + 'n%sx%d' % (tag, j), '5']
+            else:
+                options.append(prefix + 'n%sx%d=5' % (tag, j))
+            options.append(prefix + 'r%sx%d=1.5' % (tag, j))
+            options.append(prefix + 'd%sx%dNAME=value' % (tag, j))
+    if getopt and commons:
+        options.append('-' + LETTERS[:min(commons, len(LETTERS))])
+    parameters = ['target', 'extra1', 'extra2']
+    if gnu:
+        return prefix, options + parameters
+    # parameters interleaved with the options
+    return prefix, parameters[:1] + options + parameters[1:]
+
+def measure(label, matchers, commons, per_kind, getopt, gnu, runs):
+    Tool, aliases = synthesize(matchers, commons, per_kind)
+    prefix, args = command_line(matchers - 1, commons, per_kind, getopt, gnu)
+    tool = Tool(aliases=getopt and aliases or None, optionPrefix=prefix)
+    argv = ['tool'] + args
+
+    def parse():
+        return tool.process(argv, gnu=gnu, handleUsageProblems=False)
+
+    start = time.time()
+    assert parse() == matchers - 1
+    first = time.time() - start
+
+    times = []
+    for i in range(runs):
+        start = time.time()
+        parse()
+        times.append(time.time() - start)
+    times.sort()
+
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        parse()
+        objects = gc.get_count()[0] - before
+    finally:
+        gc.enable()
+
+    peak = None
+    if tracemalloc:
+        tracemalloc.start()
+        try:
+            parse()
+            peak = tracemalloc.get_traced_memory()[1] / 1024.0
+        finally:
+            tracemalloc.stop()
+
+    return {'name':'%s %s%s' % (label, getopt and 'getopt' or 'non-getopt',
+                                gnu and ' gnu' or ''),
+            'matchers':matchers, 'commons':commons, 'arguments':len(args),
+            'getopt':getopt, 'gnu':gnu,
+            'first_us':round(first*1e6, 1),
+            'us_per_parse':round(times[len(times)//2]*1e6, 1),
+            'gc_objects':objects,
+            'peak_kb':peak and round(peak, 1)}
+
+def main():
+    runs = len(sys.argv) > 1 and int(sys.argv[1]) or 200
+    baseline = None
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as f:
+            baseline = dict((s['name'], s) for s in json.load(f)['scenarios'])
+
+    scenarios = []
+    # keep anything the matchers print off the JSON
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        for label, matchers, commons, per_kind in SIZES:
+            for getopt in True, False:
+                for gnu in False, True:
+                    scenarios.append(measure(label, matchers, commons, per_kind,
+                                             getopt, gnu, runs))
+    finally:
+        sys.stdout = stdout
+
+    slower = []
+    for each in scenarios:
+        before = baseline and baseline.get(each['name'])
+        if before and each['us_per_parse'] > before['us_per_parse'] * TOLERANCE:
+            slower.append(each['name'])
+    print json.dumps({'python':platform.python_version(), 'runs':runs,
+                      'scenarios':scenarios, 'slower':slower}, indent=1)
+    return slower and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
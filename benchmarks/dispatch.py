@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+'''Per-request overhead of bottle's router versus fastpath.application
+
+Serves an install page, a manifest and an icon from a throwaway app
+directory through both WSGI entry points, with warm caches, and prints the
+mean time per request.
+
+    python benchmarks/dispatch.py [requests]
+'''
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+PLIST = '''<?xml version="1.0" encoding="UTF-8"?>
+<plist version="1.0"><dict>
+<key>CFBundleIdentifier</key><string>com.example.awesome</string>
+<key>CFBundleVersion</key><string>1.0</string>
+</dict></plist>
+'''
+
+def make_site():
+    site = tempfile.mkdtemp(prefix='icbm-bench-')
+    app = os.path.join(site, 'AwesomeApp')
+    os.mkdir(app)
+    for fname, data in [('awesome.ipa', 'x'*100000), ('AwesomeApp-Info.plist', PLIST),
+                        ('icon.png', 'i'*4000), ('icon_512.png', 'i'*40000)]:
+        with open(os.path.join(app, fname), 'wb') as f:
+            f.write(data)
+    return site
+
+def request(app, path):
+    environ = {'REQUEST_METHOD':'GET', 'PATH_INFO':path, 'QUERY_STRING':'',
+               'SERVER_NAME':'localhost', 'SERVER_PORT':'8080',
+               'HTTP_HOST':'localhost:8080', 'HTTP_USER_AGENT':'iPhone',
+               'HTTP_ACCEPT_ENCODING':'gzip', 'REMOTE_ADDR':'127.0.0.1',
+               'wsgi.url_scheme':'http', 'wsgi.input':None, 'wsgi.errors':sys.stderr}
+    status = []
+    body = app(environ, lambda s, h, exc=None: status.append(s))
+    data = ''.join(body)
+    if hasattr(body, 'close'):
+        body.close()
+    return status[0], data
+
+def timed(app, path, count):
+    start = time.time()
+    for i in xrange(count):
+        request(app, path)
+    return (time.time() - start) / count
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 2000
+    site = make_site()
+    os.chdir(site)
+    try:
+        import bottle
+        bottle.TEMPLATE_PATH.insert(0, REPO)
+        import icbm
+        import fastpath
+
+        results = []
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            for path in ['/AwesomeApp', '/AwesomeApp/manifest.xml', '/AwesomeApp/icon.png']:
+                # the first request through bottle fills the caches
+                assert request(fastpath.fallback, path)[0].startswith('200')
+                assert request(fastpath.application, path) == request(fastpath.fallback, path)
+                results.append((path, timed(fastpath.fallback, path, count),
+                                timed(fastpath.application, path, count)))
+        finally:
+            sys.stdout = stdout
+    finally:
+        shutil.rmtree(site)
+
+    print '%-28s %12s %12s %8s' % ('path', 'bottle us', 'fastpath us', 'saved')
+    for path, slow, fast in results:
+        print '%-28s %12.1f %12.1f %7.0f%%' % (path, slow*1e6, fast*1e6, 100*(1-fast/slow))
+
+if __name__ == '__main__':
+    main()
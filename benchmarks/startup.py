@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+'''Startup time of each ICBM entry point
+
+Runs every entry point in fresh interpreters against a throwaway site that
+has a saved catalog and change log of realistic size, and prints one JSON
+object with the median time from the first import to being ready (WSGI) or
+done (CLI) of each. Exits with status 1 if any entry point takes longer
+than BUDGET_MS or, given the JSON of an earlier run, is more than 25% slower
+than it was, so it can run in CI.
+
+    python benchmarks/startup.py [runs] [baseline.json]
+'''
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# milliseconds any entry point may take to be ready, with room for slow CI
+# machines; on a laptop each takes a fifth of it or less
+BUDGET_MS = 500
+
+TOLERANCE = 1.25
+
+PLIST = '''<?xml version="1.0" encoding="UTF-8"?>
+<plist version="1.0"><dict>
+<key>CFBundleIdentifier</key><string>com.example.awesome</string>
+<key>CFBundleVersion</key><string>1.0</string>
+</dict></plist>
+'''
+
+# each snippet runs in the site directory and prints its elapsed seconds
+TIMER = 'import time; start = time.time()\nimport sys; sys.path.insert(0, %r)\n' % REPO
+DONE = '\nsys.stdout = sys.__stdout__\nprint "elapsed", time.time() - start\n'
+
+ENTRY_POINTS = [
+    ('import icbm', 'import icbm'),
+    ('app.wsgi', 'import icbm\napplication = icbm.setup_server()\n'
+                 'icbm.start_background()'),
+    ('app.wsgi fast path', 'import icbm\nimport fastpath\n'
+                           'application = fastpath.application\n'
+                           'icbm.start_background()'),
+    ('icbm.py --static', 'import bottle; bottle.TEMPLATE_PATH.insert(0, %r)\n'
+                         'sys.stdout = open("/dev/null", "w")\n'
+                         'import icbm\n'
+                         'icbm.ICBM().process(["icbm.py", "--static", "http://example.com/AwesomeApp",'
+                         ' "AwesomeApp", "AwesomeApp/awesome.ipa", "AwesomeApp/Info.plist",'
+                         ' "AwesomeApp/icon.png", "AwesomeApp/icon_512.png", "out"])' % REPO),
+]
+
+def make_site(apps=5000, events=10000):
+    site = tempfile.mkdtemp(prefix='icbm-startup-')
+    app = os.path.join(site, 'AwesomeApp')
+    os.mkdir(app)
+    os.mkdir(os.path.join(site, 'out'))
+    for fname, data in [('awesome.ipa', 'x'*1000), ('Info.plist', PLIST),
+                        ('icon.png', 'i'*100), ('icon_512.png', 'i'*1000)]:
+        with open(os.path.join(app, fname), 'wb') as f:
+            f.write(data)
+
+    entries = [{'name':'App%d' % i, 'bundle_id':'com.example.app%d' % i,
+                'version':'1.0', 'ipa':'app.ipa', 'info_plist':'Info.plist',
+                'icon':'icon.png', 'published':0, 'stamp':[0, 0, 0]}
+               for i in range(apps)]
+    with open(os.path.join(site, '.icbm-catalog.json'), 'w') as f:
+        json.dump({'generated':0, 'apps':entries}, f)
+    with open(os.path.join(site, '.icbm-changes.log'), 'w') as f:
+        for i in range(events):
+            f.write(json.dumps({'seq':i+1, 'type':'publish', 'name':'App%d' % (i % apps),
+                                'time':0, 'version':'1.0'})+'\n')
+    return site
+
+def run(site, code):
+    # background threads may complain about being cut short at exit
+    with open(os.devnull, 'w') as devnull:
+        out = subprocess.check_output([sys.executable, '-c', TIMER+code+DONE],
+                                      cwd=site, stderr=devnull)
+    return float(out.split('elapsed')[-1])
+
+def main():
+    runs = len(sys.argv) > 1 and int(sys.argv[1]) or 5
+    baseline = None
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as f:
+            baseline = dict((e['name'], e) for e in json.load(f)['entry_points'])
+
+    site = make_site()
+    try:
+        results = []
+        for label, code in ENTRY_POINTS:
+            times = sorted(run(site, code) for i in range(runs))
+            results.append({'name':label,
+                            'median_ms':round(times[len(times)//2]*1000, 1)})
+    finally:
+        shutil.rmtree(site)
+
+    over = [each['name'] for each in results if each['median_ms'] > BUDGET_MS]
+    slower = []
+    for each in results:
+        before = baseline and baseline.get(each['name'])
+        if before and each['median_ms'] > before['median_ms'] * TOLERANCE:
+            slower.append(each['name'])
+    print json.dumps({'python':platform.python_version(), 'runs':runs,
+                      'budget_ms':BUDGET_MS, 'entry_points':results,
+                      'over_budget':over, 'slower':slower}, indent=1)
+    return (over or slower) and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+'''catalog - precomputed index of the apps being served
+
+The index is rebuilt off the request path (by a background thread, or
+explicitly with refresh()) and kept as a name-sorted list, so listing,
+prefix filtering and cursor pagination are all bisections over memory.
+Entries are only reloaded when their stamp changes, and the index is saved
+to disk so a restarted server has a listing before its first scan finishes.
+'''
+
+import base64
+import bisect
+import json
+import os
+import threading
+import time
+
+class CatalogIndex(object):
+    def __init__(self, roots, stamp, load, path=None, lister=None, prefetch=None):
+        '''
+        Param roots is the list of directories holding app directories.
+        Param lister(root) returns the names of the apps in a root, by
+            default its non-hidden subdirectories.
+        Param prefetch(names, entries), if given, is called before the apps
+            are stamped so it can start their lookups concurrently.
+        Param stamp(name, entry) returns a cheap change marker for the app
+            directory `name`, or None if it isn't there. entry is the
+            previous entry for the app, if any.
+        Param load(name) returns the entry dict for the app, or None if the
+            directory is not a servable app.
+        Param path is the file the index is persisted to, if any.
+        '''
+        self.roots = roots
+        self.lister = lister or _list_dirs
+        self.prefetch = prefetch
+        self.stamp = stamp
+        self.load = load
+        self.path = path
+        self.entries = {}
+        self.names = []
+        self.generated = None
+        self.ready = threading.Event()
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+        self._listeners = []
+        self._restored = False
+
+    def subscribe(self, listener):
+        '''Calls listener(added, updated, removed) after each refresh that
+        changed the index, with the lists of app names affected. The first
+        scan of an index that had nothing saved is not reported: every app
+        would look newly added.'''
+        self._listeners.append(listener)
+
+    def list_apps(self):
+        '''Lists the candidate app directories under the roots'''
+        names = set()
+        for root in self.roots:
+            names.update(self.lister(root))
+        return names
+
+    def refresh(self):
+        '''Rescans the roots, returning the (added, updated, removed) names'''
+        with self._refresh_lock:
+            self._ensure_restored()
+            baseline = self.generated is None
+            old = self.entries
+            new = {}
+            names = self.list_apps()
+            if self.prefetch:
+                self.prefetch(names, old)
+            for name in names:
+                previous = old.get(name)
+                stamp = self.stamp(name, previous)
+                if stamp is None:
+                    continue
+                if previous and previous['stamp'] == stamp:
+                    new[name] = previous
+                    continue
+                entry = self.load(name)
+                if entry:
+                    # restamp now the entry says which files to watch
+                    entry['stamp'] = self.stamp(name, entry)
+                    new[name] = entry
+
+            added = [n for n in new if n not in old]
+            updated = [n for n in new if n in old and new[n] is not old[n]]
+            removed = [n for n in old if n not in new]
+
+            with self._lock:
+                self.entries = new
+                self.names = sorted(new)
+                self.generated = time.time()
+            self.ready.set()
+
+            if added or updated or removed:
+                self._save()
+            if (added or updated or removed) and not baseline:
+                for listener in self._listeners:
+                    listener(added, updated, removed)
+            return added, updated, removed
+
+    def get(self, name):
+        self._ensure_restored()
+        return self.entries.get(name)
+
+    def page(self, prefix='', cursor=None, limit=50):
+        '''Returns (entries, next_cursor) for names starting with prefix.
+        next_cursor is None on the last page.
+        '''
+        self._ensure_restored()
+        with self._lock:
+            names, entries = self.names, self.entries
+
+        start = bisect.bisect_left(names, prefix)
+        if cursor:
+            start = max(start, bisect.bisect_right(names, decode_cursor(cursor)))
+
+        page = []
+        for name in names[start:start+limit+1]:
+            if not name.startswith(prefix):
+                break
+            page.append(entries[name])
+
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_cursor(page[-1]['name'])
+        return page, next_cursor
+
+    def count(self):
+        self._ensure_restored()
+        return len(self.names)
+
+    def start(self, interval):
+        '''Starts refreshing in a background thread every interval seconds'''
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, args=(interval,))
+            self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _run(self, interval):
+        # a saved index is served while the first scan runs
+        self._ensure_restored()
+        while True:
+            try:
+                self.refresh()
+            except Exception, ex:
+                print 'catalog refresh failed:', ex
+            time.sleep(interval)
+
+    def _ensure_restored(self):
+        # the saved index is read when first needed rather than on
+        # construction, so processes that never serve the catalog don't
+        # pay for parsing it
+        if self._restored:
+            return
+        with self._lock:
+            if self._restored:
+                return
+            self._restore()
+            self._restored = True
+
+    def _restore(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (IOError, ValueError), ex:
+            print 'ignoring unreadable catalog index', self.path, ex
+            return
+        entries = {}
+        for e in saved['apps']:
+            # names are kept as the byte strings os.listdir returns, and
+            # json turns the stamp tuples into lists
+            e = dict((k, _bytes(v)) for k, v in e.items())
+            e['stamp'] = tuple(e['stamp'])
+            entries[e['name']] = e
+        self.entries = entries
+        self.names = sorted(entries)
+        self.generated = saved['generated']
+        self.ready.set()
+
+    def _save(self):
+        if not self.path:
+            return
+        with self._lock:
+            saved = {'generated':self.generated,
+                     'apps':[self.entries[n] for n in self.names]}
+        tmp = self.path+'.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(saved, f)
+        os.rename(tmp, self.path)
+
+
+def _list_dirs(root):
+    return [n for n in os.listdir(root)
+            if not n.startswith('.') and os.path.isdir(os.path.join(root, n))]
+
+def _bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def encode_cursor(name):
+    return base64.urlsafe_b64encode(name)
+
+def decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(str(cursor))
+    except TypeError:
+        raise ValueError('bad cursor')
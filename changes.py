@@ -0,0 +1,207 @@
+'''changes - append-only log of catalog changes
+
+Every publish, update and delete gets the next sequence number and is
+appended as a JSON line to the log file, so sequence numbers keep growing
+across restarts. The most recent events are kept in memory for feed
+requests; a reader whose cursor has fallen out of that window is told to
+resync from the catalog instead.
+
+Several processes may share one log: appends take a lock on the file and
+first read what the others appended, so sequence numbers stay unique, and
+readers pick up the others' events by watching the file grow. Each of them
+sees the same catalog changes, so only one, elected with recording(),
+should append them.
+'''
+
+import collections
+import itertools
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+PUBLISH = 'publish'
+UPDATE = 'update'
+DELETE = 'delete'
+
+# how often waiting readers look for events appended by other processes
+POLL_INTERVAL = 1
+
+class ChangeLog(object):
+    def __init__(self, path=None, retain=10000):
+        self.path = path
+        self.retain = retain
+        self.events = collections.deque()
+        self._last_seq = 0
+        self._written = 0
+        # how far the log file has been read, and which file that was
+        self._offset = 0
+        self._inode = None
+        # the locked file that makes this process the recorder
+        self._recorder = None
+        self._cond = threading.Condition(threading.Lock())
+
+    @property
+    def last_seq(self):
+        with self._cond:
+            self._catch_up()
+            return self._last_seq
+
+    def append(self, kind, name, **data):
+        '''Records one event, returning its sequence number'''
+        with self._cond:
+            if not self.path:
+                return self._add(kind, name, data)['seq']
+            f = self._lock_file()
+            try:
+                # numbered after whatever other processes appended
+                self._catch_up()
+                event = self._add(kind, name, data)
+                f.seek(0, os.SEEK_END)
+                if f.tell() > self._offset:
+                    # a torn line from a crash mid-write
+                    f.write('\n')
+                f.write(json.dumps(event)+'\n')
+                f.flush()
+                self._offset = f.tell()
+                self._written += 1
+                if self._written > 2*self.retain:
+                    self._compact()
+            finally:
+                f.close()
+            return event['seq']
+
+    def recording(self):
+        '''Returns True if this process is the one of those sharing the log
+        that records changes. It is whichever first locks <path>.recorder;
+        the lock is held until the process exits, and the next process to
+        ask then takes over.'''
+        if not self.path or not fcntl:
+            return True
+        with self._cond:
+            if self._recorder:
+                return True
+            f = open(self.path+'.recorder', 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                f.close()
+                return False
+            self._recorder = f
+            return True
+
+    def _lock_file(self):
+        # the log file, opened for appending and locked against the other
+        # processes. A compaction may replace the file while we wait for
+        # the lock, in which case the new one is locked instead.
+        while True:
+            f = open(self.path, 'a+')
+            if not fcntl:
+                return f
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.stat(self.path).st_ino == os.fstat(f.fileno()).st_ino:
+                    return f
+            except OSError:
+                pass
+            f.close()
+
+    def _add(self, kind, name, data):
+        self._last_seq += 1
+        event = {'seq':self._last_seq, 'type':kind, 'name':name,
+                 'time':int(time.time())}
+        event.update(data)
+        self._keep(event)
+        self._cond.notifyAll()
+        return event
+
+    def since(self, seq, limit=100):
+        '''Returns (events, reset) for the events after seq.
+        reset is True if events after seq have already been dropped, in
+        which case the reader has to resync and continue from last_seq.
+        '''
+        with self._cond:
+            self._catch_up()
+            return self._since(seq, limit)
+
+    def wait(self, seq, timeout, limit=100):
+        '''As since(), but waits up to timeout seconds for a new event'''
+        deadline = time.time() + timeout
+        with self._cond:
+            self._catch_up()
+            while self._last_seq == seq:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(min(remaining, POLL_INTERVAL))
+                self._catch_up()
+            return self._since(seq, limit)
+
+    def _since(self, seq, limit):
+        first = self.events and self.events[0]['seq'] or self._last_seq + 1
+        if seq < first - 1 or seq > self._last_seq:
+            return [], True
+        # sequence numbers are contiguous, so seq maps straight to an offset
+        start = seq - first + 1
+        return list(itertools.islice(self.events, start, start+limit)), False
+
+    def _keep(self, event):
+        self.events.append(event)
+        while len(self.events) > self.retain:
+            self.events.popleft()
+
+    def _catch_up(self):
+        # reads the events appended to the log since it was last read, all
+        # of it if a compaction replaced it. The log is only read when first
+        # needed, so commands that never touch the feed don't parse it; a
+        # read that fails is retried by the next call.
+        if not self.path:
+            return
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+        if st.st_ino == self._inode and st.st_size == self._offset:
+            return
+
+        with open(self.path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != self._inode or st.st_size < self._offset:
+                self.events.clear()
+                self._inode, self._offset, self._written = st.st_ino, 0, 0
+            f.seek(self._offset)
+            last_seq = self._last_seq
+            for line in f:
+                if not line.endswith('\n'):
+                    # still being written, or torn by a crash
+                    break
+                self._offset += len(line)
+                self._written += 1
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # the rest of a torn line
+                    continue
+                if not self.events or event['seq'] > self.events[-1]['seq']:
+                    self._keep(event)
+        if self.events:
+            self._last_seq = max(self._last_seq, self.events[-1]['seq'])
+        if self._last_seq != last_seq:
+            self._cond.notifyAll()
+
+    def _compact(self):
+        # rewrite the log with only the retained events so it can't grow
+        # without bound; sequence numbers carry on from the last event
+        tmp = self.path+'.tmp'
+        with open(tmp, 'w') as f:
+            for event in self.events:
+                f.write(json.dumps(event)+'\n')
+            f.flush()
+            self._inode, self._offset = os.fstat(f.fileno()).st_ino, f.tell()
+        os.rename(tmp, self.path)
+        self._written = len(self.events)
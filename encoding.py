@@ -0,0 +1,57 @@
+'''encoding - content-coding negotiation and compression
+
+gzip is always available; brotli is used when the brotli module is
+installed. Output is deterministic (gzip headers carry no timestamp), so the
+same content always compresses to the same bytes.
+'''
+
+import gzip
+import StringIO
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+def available():
+    '''Supported encodings, most preferred first'''
+    if brotli:
+        return ['br', 'gzip']
+    return ['gzip']
+
+def negotiate(accept_encoding):
+    '''Picks the best supported encoding allowed by an Accept-Encoding
+    header, or None for the identity encoding'''
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        coding, q = parts[0].strip().lower(), 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+
+    best, best_q = None, 0.0
+    for coding in available():
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+def compress(data, encoding):
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    if encoding == 'br':
+        return brotli.compress(data)
+    if encoding == 'gzip':
+        out = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=9, mtime=0) as f:
+            f.write(data)
+        return out.getvalue()
+    raise ValueError('unsupported encoding ' + encoding)
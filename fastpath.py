@@ -0,0 +1,107 @@
+'''fastpath - a lean WSGI entry point for the hot ICBM urls
+
+Install pages, manifests and small files such as icons are answered straight
+from icbm's caches, without going through bottle's router and its
+thread-local request and response objects. Anything else (internal /_icbm
+endpoints, the catalog, cache misses, large files, apps on other nodes) is
+handed to the bottle application, which also fills the caches for next
+time. Use it from app.wsgi:
+
+    import fastpath
+    application = fastpath.application
+'''
+
+import stat
+import urllib
+
+import icbm
+from scanner import ScanTimeout
+
+fallback = icbm.setup_server()
+
+BUSY = ('503 Service Unavailable',
+        [('Content-Type', 'text/plain'), ('Retry-After', str(icbm.RETRY_AFTER))],
+        'server busy, try again shortly')
+
+def _split(path_info):
+    # (name, action) for /<name>, /<name>/ and /<name>/<action>, or None
+    prefix = icbm.BASE_PATH+'/'
+    if not path_info.startswith(prefix):
+        return None
+    parts = path_info[len(prefix):].split('/')
+    if len(parts) > 2 or not parts[0] or parts[0] == '_icbm':
+        return None
+    return parts[0], len(parts) == 2 and parts[1] or None
+
+def _encoded(environ, body, content_type, vary):
+    body, coding = icbm._encode(body, environ.get('HTTP_ACCEPT_ENCODING'))
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    headers = [('Content-Type', content_type), ('Content-Length', str(len(body))),
+               ('Vary', vary)]
+    if coding:
+        headers.append(('Content-Encoding', coding))
+    return '200 OK', headers, body
+
+def _page(environ, name, path, st):
+    icbm.scanner.prefetch('listdir', [path])
+    page = icbm.page_cache.get(icbm._page_key(name, st.st_mtime, environ))
+    if page is not None:
+        return _encoded(environ, page, 'text/html; charset=UTF-8', 'Accept-Encoding')
+
+def _manifest(environ, name, path):
+    base_url = icbm._manifest_base_url(name, environ)
+    info_plist = icbm.find_app_files(path).info_plist
+    key = info_plist and icbm._manifest_key(name, base_url, path, info_plist)
+    manifest = key and icbm.manifest_cache.get(key)
+    if manifest:
+        icbm._count_install(name)
+        return _encoded(environ, manifest, 'application/xml',
+                        icbm.MIRROR_HEADER+', Accept-Encoding')
+
+def _asset(environ, path, action):
+    entry = icbm._small_asset_entry(path, action)
+    if not entry:
+        return None
+    size, mtime, data, headers = entry
+    if environ.get('HTTP_IF_NONE_MATCH') == headers['ETag']:
+        return '304 Not Modified', [('ETag', headers['ETag'])], ''
+    return '200 OK', headers.items(), data
+
+def _dispatch(environ, name, action):
+    name = urllib.unquote(name)
+    path = icbm.app_path(name, icbm.SCAN_TIMEOUT)
+    if not path:
+        return None
+    st = icbm.scanner.stat(path)
+    if not st or not stat.S_ISDIR(st.st_mode):
+        return None
+
+    if action and action != 'manifest.xml':
+        return _asset(environ, path, action)
+
+    if not icbm.page_gate.acquire():
+        return BUSY
+    try:
+        if action:
+            return _manifest(environ, name, path)
+        return _page(environ, name, path, st)
+    finally:
+        icbm.page_gate.release()
+
+def application(environ, start_response):
+    method = environ.get('REQUEST_METHOD', 'GET')
+    route = method in ('GET', 'HEAD') and _split(environ.get('PATH_INFO', ''))
+    if route:
+        try:
+            result = _dispatch(environ, *route)
+        except ScanTimeout:
+            result = BUSY
+        except OSError:
+            # bottle's routes answer lookup errors
+            result = None
+        if result:
+            status, headers, body = result
+            start_response(status, headers)
+            return [method != 'HEAD' and body or '']
+    return fallback(environ, start_response)
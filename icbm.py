@@ -1,17 +1,369 @@
 #!/usr/bin/env python
 import os
+import errno
 import string
-import plistlib
+import stat
 import urllib
-import urlparse
+import json
 import time
+import hashlib
 import sys
+import threading
+import functools
 
 BASE_PATH=''
 HTML_TEMPLATE='install.html'
+
+# admission control: IPA/asset transfers and page/manifest requests are
+# limited separately so that a release storm of downloads can't starve the
+# small metadata requests iOS needs to start an install. A queued request
+# holds a server thread while it waits, so by default transfers beyond
+# MAX_ASSET_TRANSFERS are answered 503 at once; transfers and their queue
+# are cut to fit in SERVER_THREADS with a thread to spare for pages and
+# manifests.
+MAX_ASSET_TRANSFERS=3
+ASSET_QUEUE=0
+ASSET_QUEUE_TIMEOUT=5
+MAX_PAGE_REQUESTS=16
+PAGE_QUEUE=32
+PAGE_QUEUE_TIMEOUT=2
+RETRY_AFTER=10
+
+# the number of threads the server runs requests on: threads= in the
+# mod_wsgi configuration (bottle's own server, python icbm.py host port, has
+# one). Requests that wait for changes may only hold the threads left over
+# after asset transfers, their queue and one for pages and manifests.
+SERVER_THREADS=5
+
+# bandwidth shaping for asset transfers, in bytes/second. TOTAL_BANDWIDTH is
+# shared fairly between clients downloading at the same time; 0 disables
+# shaping. PER_CLIENT_BANDWIDTH optionally caps any single client.
+TOTAL_BANDWIDTH=0
+PER_CLIENT_BANDWIDTH=0
+
+# the catalog listing is served from an index that is refreshed every
+# CATALOG_REFRESH seconds in the background and saved to CATALOG_FILE
+CATALOG_TEMPLATE='catalog.html'
+CATALOG_FILE='.icbm-catalog.json'
+CATALOG_REFRESH=60
+CATALOG_PAGE_SIZE=50
+CATALOG_MAX_PAGE_SIZE=500
+
+# changes to the catalog are appended to CHANGES_FILE and served as a feed;
+# long-polling readers hold a worker thread each, so at most MAX_WATCHERS of
+# them, within SERVER_THREADS, may wait at once (the rest get an immediate
+# answer). Several processes may share CHANGES_FILE.
+CHANGES_FILE='.icbm-changes.log'
+CHANGES_RETAIN=10000
+CHANGES_PAGE_SIZE=100
+MAX_WATCHERS=2
+LONGPOLL_TIMEOUT=30
+
+# server-sent event streams announcing new builds to install pages. Each
+# open stream holds a worker thread, so they are off unless LIVE_UPDATES is
+# set, get at most MAX_STREAMS of the threads SERVER_THREADS leaves after
+# long-polls, and are closed after STREAM_MAX_AGE seconds (browsers
+# reconnect and resume by event id). Pages whose stream is refused check the
+# change feed every LIVE_POLL_INTERVAL seconds instead.
+LIVE_UPDATES=False
+LIVE_POLL_INTERVAL=60
+MAX_STREAMS=4
+STREAM_HEARTBEAT=15
+STREAM_MAX_AGE=300
+
+# replication: set FOLLOW_LEADER to the base URL of another ICBM node to
+# pull its builds every SYNC_INTERVAL seconds. With SYNC_PRUNE, apps removed
+# from the leader are removed here too. The leader needs REPLICA_ROUTE,
+# which serves GET /_icbm/replica from digests computed in the background as
+# apps are published.
+FOLLOW_LEADER=None
+SYNC_INTERVAL=60
+SYNC_PRUNE=False
+REPLICA_ROUTE=False
+
+# storage roots, as (root id, location) pairs. Apps are assigned to roots by
+# consistent hashing of their name; a location is either a local directory
+# or the base URL of the ICBM node serving that root, which requests for its
+# apps are redirected to. Ids must be the same on every node. Empty means
+# every app lives in the current directory.
+STORAGE_ROOTS=[]
+RING_REPLICAS=100
+
+# fan-out layout: with FANOUT_LEVELS set, app directories live in nested
+# directories named after the md5 of the app name (ab/cd/AwesomeApp for 2
+# levels of width 2). Convert an existing tree with --migrate-layout.
+FANOUT_LEVELS=0
+FANOUT_WIDTH=2
+
+# filesystem metadata (stats and listings) is looked up by SCAN_WORKERS
+# threads and cached for SCAN_TTL seconds; stale results are used for up to
+# SCAN_MAX_STALE seconds while they are refreshed. Requests give up on a
+# lookup after SCAN_TIMEOUT seconds and answer 503, background work after
+# BACKGROUND_SCAN_TIMEOUT.
+SCAN_WORKERS=8
+SCAN_TTL=2
+SCAN_MAX_STALE=30
+SCAN_TIMEOUT=2
+BACKGROUND_SCAN_TIMEOUT=60
+
+# download mirrors for ipa and icon bytes, as name -> base URL; a mirror
+# must serve an app's files at <base>/<app name>/<file>. Clients in one of
+# MIRROR_NETWORKS (cidr, mirror name) get that mirror's URLs in their
+# manifest, and any client can pick one with the MIRROR_HEADER header or a
+# ?mirror= query ('origin' for this server). Manifests are cached per mirror
+# and build in up to MANIFEST_CACHE_SIZE entries.
+MIRRORS={}
+MIRROR_NETWORKS=[]
+MIRROR_HEADER='X-ICBM-Mirror'
+MANIFEST_CACHE_SIZE=1024
+
+# pages, manifests and listings are sent gzip (or brotli, if the module is
+# installed) encoded to clients that accept it. Rendered install pages are
+# cached per build in up to PAGE_CACHE_SIZE entries, and compressed bodies
+# in up to ENCODED_CACHE_BYTES.
+PAGE_CACHE_SIZE=1024
+ENCODED_CACHE_BYTES=16*1024*1024
+COMPRESS_MIN_SIZE=256
+
+# app files up to ASSET_CACHE_MAX_FILE bytes (icons, mostly) are kept in
+# memory, along with their headers, in up to ASSET_CACHE_BYTES. An entry is
+# used for as long as the file's size and mtime are unchanged.
+ASSET_CACHE_BYTES=32*1024*1024
+ASSET_CACHE_MAX_FILE=256*1024
+
+# with PROFILER_ROUTES, POST /_icbm/profile/start starts sampling every
+# thread's stack each PROFILER_INTERVAL seconds (for PROFILER_MAX_DURATION
+# seconds at most), and GET /_icbm/profile or POST /_icbm/profile/stop return
+# the stacks in collapsed (flame graph) format.
+PROFILER_ROUTES=False
+PROFILER_INTERVAL=0.005
+PROFILER_MAX_DURATION=300
+
+# with MEMORY_ROUTES, POST /_icbm/memory/start starts taking snapshots,
+# POST /_icbm/memory/snapshot/<name> takes a named snapshot of the objects
+# counted by type (the last MEMORY_SNAPSHOTS are kept), and GET
+# /_icbm/memory/top/<name> and /_icbm/memory/diff/<old>/<new> list the
+# types taking the most memory and those that grew the most (see memtrace).
+MEMORY_ROUTES=False
+MEMORY_SNAPSHOTS=8
+
+# warming an app fills every cache for its current build before clients
+# ask: listing, page cache (readahead) for its files, file digests, icons,
+# and manifests, install pages and their compressed variants for each of
+# WARM_URLS (the urls clients reach this server at, e.g.
+# 'https://icbm.example.com') and each mirror. The server can't tell its own
+# urls before a request comes in, so with WARM_URLS empty no install pages,
+# and only the mirrors' manifests, are warmed. With WARM_ON_PUBLISH, apps
+# are warmed as the catalog finds them published or updated; with
+# WARM_ROUTE, POST /_icbm/warm/<name> warms one (python icbm.py --warm
+# --server=URL <names> calls it).
+WARM_URLS=[]
+WARM_ON_PUBLISH=False
+WARM_ROUTE=False
+
+# with ANALYTICS_FILE set, manifest requests (installs) and ipa downloads
+# (started, resumed and completed, and bytes sent) are counted per app and
+# build in ANALYTICS_BUCKET second buckets. Requests only count in memory; a
+# background thread adds the counts to the ANALYTICS_FILE SQLite database
+# every ANALYTICS_FLUSH seconds. GET /_icbm/analytics/top?hours=24 lists the
+# builds with the most completed downloads (by=installs, started, resumed,
+# bytes or unknown to rank by another count, limit=N for more). Downloads
+# the server sends from the file without reading it (mod_wsgi's
+# wsgi.file_wrapper) count as unknown rather than completed, unless
+# ANALYTICS_SENDFILE is off and downloads go through Python in blocks.
+ANALYTICS_FILE=None
+ANALYTICS_FLUSH=10
+ANALYTICS_BUCKET=3600
+ANALYTICS_SENDFILE=True
+
+# python icbm.py --daemon keeps a warm process that runs commands sent with
+# python icbmd.py <icbm.py arguments>, up to DAEMON_WORKERS at a time
+DAEMON_WORKERS=4
+
 sys.path.append('./deps/bottle/')
 
-from bottle import route, run, request, response, static_file, HTTPError, template
+from admission import AdmissionGate, guard_body
+from bandwidth import BandwidthManager
+from catalog import CatalogIndex
+from changes import ChangeLog, PUBLISH, UPDATE, DELETE
+from layout import app_location, list_apps, migrate, is_app_dir
+from scanner import Scanner, ScanTimeout
+from mirrors import MirrorSelector
+from lrucache import LRUCache
+import encoding
+
+# the server state, made by setup(): admission gates, bandwidth shaping,
+# caches, the filesystem scanner, the storage ring, the catalog and the
+# change log. Importing icbm only defines things.
+asset_gate = page_gate = watch_gate = stream_gate = None
+bandwidth = changelog = scanner = mirrors = None
+manifest_cache = page_cache = encoded_cache = asset_cache = None
+ring = catalog = None
+
+# bottle's, bound by _web() when serving or rendering pages
+request = response = static_file = HTTPError = template = redirect = None
+
+# made, and their modules imported, when first used, so that commands and
+# servers that don't use them don't pay for them (see _lazy)
+follower = None
+hashes = None
+replicas = None
+sampler = None
+memory_tracer = None
+analytics = None
+command_line = None
+readahead = None
+_lazy_lock = threading.RLock()
+
+def _lazy(name, make):
+    # the module-level object called name, made with make() the first time
+    # (make may get other lazy objects, hence the RLock)
+    obj = globals()[name]
+    if obj is None:
+        with _lazy_lock:
+            obj = globals()[name]
+            if obj is None:
+                obj = globals()[name] = make()
+    return obj
+
+def _hashes():
+    from replication import HashCache
+    return _lazy('hashes', HashCache)
+
+def _replicas():
+    def _make():
+        from replication import ReplicaIndex
+        return ReplicaIndex(app_path, _hashes())
+    return _lazy('replicas', _make)
+
+def _sampler():
+    def _make():
+        from sampler import Sampler
+        return Sampler(PROFILER_INTERVAL, PROFILER_MAX_DURATION)
+    return _lazy('sampler', _make)
+
+def _memory_tracer():
+    def _make():
+        from memtrace import MemoryTracer
+        return MemoryTracer(MEMORY_SNAPSHOTS)
+    return _lazy('memory_tracer', _make)
+
+def _analytics():
+    # None unless ANALYTICS_FILE is set
+    def _make():
+        from analytics import Analytics
+        return Analytics(ANALYTICS_FILE, ANALYTICS_BUCKET)
+    return ANALYTICS_FILE and _lazy('analytics', _make)
+
+def setup():
+    '''Makes the server state from the configuration above, once. Servers
+    and WSGI applications get it from setup_server(); commands call this'''
+    global asset_gate, page_gate, watch_gate, stream_gate, bandwidth, changelog, \
+        scanner, mirrors, manifest_cache, page_cache, encoded_cache, asset_cache, \
+        ring, catalog
+    if catalog:
+        return
+    with _lazy_lock:
+        if catalog:
+            return
+        asset_gate = AdmissionGate('asset', MAX_ASSET_TRANSFERS, ASSET_QUEUE, ASSET_QUEUE_TIMEOUT)
+        page_gate = AdmissionGate('page', MAX_PAGE_REQUESTS, PAGE_QUEUE, PAGE_QUEUE_TIMEOUT)
+        watch_gate = AdmissionGate('watch', 0)
+        stream_gate = AdmissionGate('stream', 0)
+        _size_gates()
+        bandwidth = BandwidthManager(TOTAL_BANDWIDTH, PER_CLIENT_BANDWIDTH)
+        changelog = ChangeLog(CHANGES_FILE, CHANGES_RETAIN)
+        scanner = Scanner(SCAN_WORKERS, SCAN_TIMEOUT, SCAN_TTL, SCAN_MAX_STALE)
+        mirrors = MirrorSelector(MIRRORS, MIRROR_NETWORKS)
+        manifest_cache = LRUCache(MANIFEST_CACHE_SIZE)
+        page_cache = LRUCache(PAGE_CACHE_SIZE)
+        encoded_cache = LRUCache(ENCODED_CACHE_BYTES, ENCODED_CACHE_BYTES)
+        asset_cache = LRUCache(ASSET_CACHE_BYTES, ASSET_CACHE_BYTES, lambda entry: len(entry[2]))
+        if STORAGE_ROOTS:
+            from sharding import HashRing
+            ring = HashRing(STORAGE_ROOTS, RING_REPLICAS)
+        # last, as it marks the state as made
+        index = CatalogIndex(local_roots(), _app_stamp, _app_entry, CATALOG_FILE,
+                             _list_apps, _prefetch_stamps)
+        for listener in _record_changes, _warm_published, _describe_published:
+            index.subscribe(listener)
+        catalog = index
+
+_routes = []
+_routes_added = False
+
+def route(path, method='GET'):
+    # records a route for setup_server() to add to bottle's application
+    def _record(callback):
+        _routes.append((path, method, callback))
+        return callback
+    return _record
+
+def _web():
+    # imports bottle, for the routes and for rendering pages
+    global request, response, static_file, HTTPError, template, redirect
+    from bottle import request, response, static_file, HTTPError, template, redirect
+
+def setup_server():
+    '''Makes the server state and adds the routes to bottle's default
+    application, which it returns'''
+    global _routes_added
+    setup()
+    _web()
+    import bottle
+    with _lazy_lock:
+        if not _routes_added:
+            for path, method, callback in _routes:
+                bottle.route(path, method=method)(callback)
+            _routes_added = True
+    return bottle.default_app()
+
+def _size_gates():
+    # asset transfers, and the requests waiting for one, leave a thread for
+    # pages and manifests
+    asset_gate.limit = max(1, min(MAX_ASSET_TRANSFERS, SERVER_THREADS - 1))
+    asset_gate.queue = max(0, min(ASSET_QUEUE, SERVER_THREADS - asset_gate.limit - 1))
+    # threads that can be held waiting without starving downloads, those
+    # queued for one, pages and manifests
+    held = max(0, SERVER_THREADS - asset_gate.limit - asset_gate.queue - 1)
+    watch_gate.limit = min(MAX_WATCHERS, held)
+    stream_gate.limit = LIVE_UPDATES and min(MAX_STREAMS, held - watch_gate.limit) or 0
+
+def app_path(name, timeout=None):
+    '''Returns where the app lives on disk, or None if another node has it.
+    Finding it in a fan-out layout looks up to timeout seconds
+    (BACKGROUND_SCAN_TIMEOUT by default) before raising ScanTimeout.'''
+    location = '.'
+    if ring:
+        from sharding import is_remote
+        location = ring.location(name)
+        if is_remote(location):
+            return None
+    def _exists(path):
+        try:
+            return scanner.stat(path, timeout or BACKGROUND_SCAN_TIMEOUT) is not None
+        except OSError:
+            # as os.path.exists; the caller's own stat reports it
+            return False
+    return app_location(location, name, FANOUT_LEVELS, FANOUT_WIDTH, _exists)
+
+def local_roots():
+    if not ring:
+        return ['.']
+    return [location for root_id, location in ring.local_roots()]
+
+def _shipped_dirs(root):
+    # the directories that come with ICBM, when apps are kept next to it
+    if os.path.abspath(root) == os.path.dirname(os.path.abspath(__file__)):
+        return ('deps', 'benchmarks')
+    return ()
+
+def _list_apps(root):
+    def _subdirs(path):
+        return scanner.subdirs(path, BACKGROUND_SCAN_TIMEOUT)
+    def _prefetch(paths):
+        scanner.prefetch('subdirs', paths)
+    return list_apps(root, FANOUT_LEVELS, FANOUT_WIDTH, _subdirs, _prefetch)
 
 def make_manifest(meta, assets):
     root = {}
@@ -23,6 +375,7 @@ def make_manifest(meta, assets):
     items.append(items0)
     root['items'] = items
 
+    import plistlib
     if 'writePlistToBytes' in plistlib.__all__:
         return plistlib.writePlistToBytes(root)
     else:
@@ -56,26 +409,97 @@ def _easy_match(haystack, needle):
 
     return needle.lower() in haystack
 
-def _base_url():
-    p = urlparse.urlsplit(request.url)
-    return p.scheme+'://'+p.netloc+'/'+BASE_PATH
+def _base_url(environ=None):
+    # worked out from the WSGI environ, as bottle does for request.url, so
+    # the fast path (fastpath.py) arrives at the same urls
+    env = environ or request.environ
+    scheme = env.get('HTTP_X_FORWARDED_PROTO') or env.get('wsgi.url_scheme', 'http')
+    host = env.get('HTTP_X_FORWARDED_HOST') or env.get('HTTP_HOST')
+    if not host:
+        host = env.get('SERVER_NAME', '127.0.0.1')
+        port = env.get('SERVER_PORT')
+        if port and port != (scheme == 'http' and '80' or '443'):
+            host += ':'+port
+    return scheme+'://'+host+'/'+BASE_PATH
+
+def _needs_browser_warning(environ=None):
+    ua = (environ or request.environ).get('HTTP_USER_AGENT') or ''
+    print 'user agent is', ua
+    acceptable_uas = ['iPod', 'iPhone', 'iPad']
+    return not len(filter(lambda x: x in ua, acceptable_uas))
 
-def install_page(name, base_url = None, browser_check=True):
+def install_page(name, base_url = None, browser_check=True, browser_warning=False, server_url=None):
+    events_url = changes_url = None
     if not base_url:
-        base_url = _base_url()+name
+        server_url = server_url or _base_url()
+        base_url = server_url+name
+        if LIVE_UPDATES:
+            events_url = server_url+'_icbm/events/'+urllib.quote(name)
+            changes_url = server_url+'_icbm/changes'
     manifest_url = base_url+'/manifest.xml'
     install_url = 'itms-services://?action=download-manifest&url='+manifest_url
 
-    browser_warning = False
     if browser_check:
-        ua = request.headers.get('User-Agent')
-        print 'user agent is', ua
-        acceptable_uas = ['iPod', 'iPhone', 'iPad']
-        browser_warning = not len(filter(lambda x: x in ua, acceptable_uas))
+        browser_warning = _needs_browser_warning()
 
-    return template(HTML_TEMPLATE, install_url=install_url, name=name,timestamp=time.ctime(), browser_warning = browser_warning)
+    # the name as a javascript string, which can't end the script element
+    name_js = json.dumps(name).replace('</', '<\\/')
+    return template(HTML_TEMPLATE, install_url=install_url, name=name,timestamp=time.ctime(), browser_warning = browser_warning,
+                    events_url=events_url, changes_url=changes_url, name_js=name_js, poll_interval=LIVE_POLL_INTERVAL)
 
-def install_manifest(name, static=False, base_url=None, ipa_file=None, plist_file=None, icon_file=None, icon512_file=None, icon_gloss=True):
+def find_app_files(name, timeout=None):
+    class Files(object):
+        pass
+
+    files = Files()
+    files.ipa = None
+    files.icon = None
+    files.icon_512 = None
+    files.info_plist = None
+    files.icon_gloss = True
+
+    # only the top level of the app directory is considered
+    for fname in scanner.listdir(name, timeout):
+        ext = os.path.splitext(fname)[-1]
+        # first .ipa we find, that's our application file
+        if ext == '.ipa':
+            files.ipa = fname
+        elif ext == '.png':
+            if _easy_match(fname, '512'):
+                files.icon_512 = fname
+            else:
+                files.icon = fname
+
+            if _easy_match(fname, 'no_gloss'):
+                files.icon_gloss = False
+        elif ext == '.plist':
+            if _easy_match(fname, 'info'):
+                files.info_plist = os.path.join(name, fname)
+
+    return files
+
+def _manifest_base_url(name, environ):
+    # the mirror the client should download from, or this server
+    requested = environ.get('HTTP_'+MIRROR_HEADER.upper().replace('-', '_'))
+    if not requested:
+        import urlparse
+        requested = urlparse.parse_qs(environ.get('QUERY_STRING', '')).get('mirror', [None])[-1]
+    mirror, mirror_base = mirrors.select(environ.get('REMOTE_ADDR'), requested)
+    if mirror:
+        return mirror_base+'/'+urllib.quote(name)
+    return _base_url(environ)+name
+
+def _manifest_key(name, base_url, path, info_plist):
+    # the listing decides the urls and the plist the metadata, so their
+    # mtimes identify the build the manifest was made for
+    dir_stat, plist_stat = scanner.stat(path), scanner.stat(info_plist)
+    if dir_stat and plist_stat:
+        return (name, base_url, dir_stat.st_mtime, plist_stat.st_mtime)
+
+def _page_key(name, mtime, environ):
+    return (name, _base_url(environ), _needs_browser_warning(environ), mtime)
+
+def install_manifest(name, static=False, base_url=None, ipa_file=None, plist_file=None, icon_file=None, icon512_file=None, icon_gloss=True, path=None):
     class Ctx(object):
         pass
 
@@ -95,61 +519,695 @@ def install_manifest(name, static=False, base_url=None, ipa_file=None, plist_fil
         ctx.icon_gloss = icon_gloss
 
     else:
-        ctx.base_url =_base_url()+name
-        ctx.ipa_url = None
-        ctx.icon_512_url = None
-        ctx.icon_url= None
-        ctx.info_plist = None
-        ctx.icon_gloss = True
-
-        def _skywalker(arg, dirname, fnames):
-            for fname in fnames:
-                ext = os.path.splitext(fname)[-1]
-                url = ctx.base_url+'/'+urllib.quote(fname)
-                # first .ipa we find, that's our application file
-                if ext == '.ipa':
-                    ctx.ipa_url = url
-                elif ext == '.png':
-                    if _easy_match(fname, '512'):
-                        ctx.icon_512_url = url
-                    else:
-                        ctx.icon_url = url
+        response.content_type = "application/xml"
+        response.headers['Vary'] = MIRROR_HEADER
+        return _app_manifest(name, _manifest_base_url(name, request.environ), path or name)
 
-                    if _easy_match(fname, 'no_gloss'):
-                        ctx.icon_gloss = False
-                elif ext == '.plist':
-                    if _easy_match(fname, 'info'):
-                        ctx.info_plist = os.path.join(dirname, fname)
+    return _render_manifest(name, ctx.info_plist, ctx.ipa_url, ctx.icon_url, ctx.icon_512_url, ctx.icon_gloss)
 
-            # ensure we only do a top level walk
-            fnames[:]=[]
+def _render_manifest(name, info_plist, ipa_url, icon_url, icon_512_url, icon_gloss):
+    import plistlib
+    plist = plistlib.readPlist(info_plist)
 
-        os.path.walk(name, _skywalker, None)
+    meta = make_meta(plist['CFBundleIdentifier'], plist['CFBundleVersion'], name)
+    assets = make_assets(ipa_url, icon_url, icon_512_url, icon_gloss)
+    return make_manifest(meta, assets)
 
-        # $todo move this into install_page otherwise the 404 is invisible to
-        # the user
-        if not ctx.info_plist:
-            return HTTPError(code=404, output='info plist not found')
+def _app_manifest(name, base_url, path, timeout=None):
+    # the manifest for clients downloading from base_url, from the cache
+    # while the build is unchanged
+    files = find_app_files(path, timeout)
 
-        if not ctx.ipa_url:
-            return HTTPError(code=404, output='ipa not found')
+    def _make_url(fname):
+        if fname:
+            return base_url+'/'+urllib.quote(fname)
 
-        if not ctx.icon_url:
-            return HTTPError(code=404, output='icon not found')
+    # $todo move this into install_page otherwise the 404 is invisible to
+    # the user
+    if not files.info_plist:
+        return HTTPError(code=404, output='info plist not found')
 
-        if not ctx.icon_512_url:
-            return HTTPError(code=404, output='512 icon not found')
+    if not files.ipa:
+        return HTTPError(code=404, output='ipa not found')
 
-        response.content_type = "application/xml"
+    if not files.icon:
+        return HTTPError(code=404, output='icon not found')
 
-    plist = plistlib.readPlist(ctx.info_plist)
-
-    meta = make_meta(plist['CFBundleIdentifier'], plist['CFBundleVersion'], name)
-    assets = make_assets(ctx.ipa_url, ctx.icon_url, ctx.icon_512_url, ctx.icon_gloss)
-    manifest = make_manifest(meta, assets)
+    if not files.icon_512:
+        return HTTPError(code=404, output='512 icon not found')
 
+    # the listing decides the urls and the plist the metadata, so their
+    # mtimes identify the build the manifest was made for
+    key = _manifest_key(name, base_url, path, files.info_plist)
+    if not key:
+        return HTTPError(404, 'info plist not found')
+    manifest = manifest_cache.get(key)
+    if not manifest:
+        manifest = _render_manifest(name, files.info_plist, _make_url(files.ipa), _make_url(files.icon),
+                                    _make_url(files.icon_512), files.icon_gloss)
+        manifest_cache.put(key, manifest)
     return manifest
 
+def _app_stamp(name, entry):
+    # the directory mtime catches files being added or removed, the ipa and
+    # plist mtimes catch builds copied over the previous one
+    path = app_path(name)
+    if not path:
+        return None
+    st = scanner.stat(path, BACKGROUND_SCAN_TIMEOUT)
+    if not st:
+        return None
+    stamp = [st.st_mtime]
+    if entry:
+        for fname in entry['ipa'], entry['info_plist']:
+            st = scanner.stat(os.path.join(path, fname), BACKGROUND_SCAN_TIMEOUT)
+            stamp.append(st and st.st_mtime)
+    return tuple(stamp)
+
+def _prefetch_stamps(names, entries):
+    paths = []
+    for name in names:
+        path = app_path(name)
+        if path:
+            paths.append(path)
+            entry = entries.get(name)
+            if entry:
+                paths.append(os.path.join(path, entry['ipa']))
+                paths.append(os.path.join(path, entry['info_plist']))
+    scanner.prefetch('stat', paths)
+
+def _app_entry(name):
+    path = app_path(name)
+    files = find_app_files(path, BACKGROUND_SCAN_TIMEOUT)
+    if not files.ipa or not files.info_plist:
+        return None
+
+    import plistlib
+    try:
+        plist = plistlib.readPlist(files.info_plist)
+    except Exception, ex:
+        print 'unreadable info plist', files.info_plist, ex
+        return None
+
+    return {'name':name,
+            'bundle_id':plist.get('CFBundleIdentifier'),
+            'version':plist.get('CFBundleVersion'),
+            'ipa':files.ipa,
+            'info_plist':os.path.basename(files.info_plist),
+            'icon':files.icon,
+            'published':int(scanner.stat(os.path.join(path, files.ipa), BACKGROUND_SCAN_TIMEOUT).st_mtime)}
+
+def _record_changes(added, updated, removed):
+    # every process sharing the log sees the same changes
+    if not changelog.recording():
+        return
+    for kind, names in (PUBLISH, added), (UPDATE, updated):
+        for name in names:
+            changelog.append(kind, name, version=catalog.get(name)['version'])
+    for name in removed:
+        changelog.append(DELETE, name)
+
+def _warm_environs():
+    # what the requests of iOS devices and of desktop browsers would carry
+    # for each of WARM_URLS
+    import urlparse
+    environs = []
+    for url in WARM_URLS:
+        parts = urlparse.urlparse(url)
+        for ua in 'iPhone', '':
+            environs.append({'wsgi.url_scheme':parts.scheme, 'HTTP_HOST':parts.netloc,
+                             'HTTP_USER_AGENT':ua})
+    return environs
+
+# from <fcntl.h>, the same on every platform that has posix_fadvise
+POSIX_FADV_WILLNEED = 3
+
+def _readahead_call():
+    # f(fd, size) asking the kernel to read a file into the page cache in
+    # the background: os.posix_fadvise on Python 3, libc's posix_fadvise or
+    # Linux's readahead through ctypes on 2.7. False if there is none, as
+    # reading the file here would hold up the warm-up for as long as that
+    if hasattr(os, 'posix_fadvise'):
+        return lambda fd, size: os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    import ctypes
+    import ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+    except OSError:
+        return False
+    # the 64-bit offset variants, whatever the platform's off_t
+    fadvise = getattr(libc, 'posix_fadvise64', None)
+    if fadvise:
+        fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+        return lambda fd, size: fadvise(fd, 0, 0, POSIX_FADV_WILLNEED)
+    readahead = getattr(libc, 'readahead', None)
+    if readahead:
+        readahead.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_size_t]
+        return lambda fd, size: readahead(fd, 0, size)
+    return False
+
+def _readahead(path):
+    # only advice: the kernel may read less, or nothing, and errors are
+    # no reason to stop warming
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        _lazy('readahead', _readahead_call)(fd, os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+
+def warm_app(name):
+    '''Fills the caches for an app's current build. Returns the seconds
+    taken by each step, as [(step, seconds)], or None if the app is not
+    here or is incomplete'''
+    timings = []
+    def _step(label, f, *args):
+        start = time.time()
+        ret = f(*args)
+        timings.append((label, time.time() - start))
+        return ret
+
+    path = app_path(name)
+    st = path and _step('stat', scanner.stat, path, BACKGROUND_SCAN_TIMEOUT)
+    if not st or not stat.S_ISDIR(st.st_mode):
+        return None
+    files = _step('listing', find_app_files, path, BACKGROUND_SCAN_TIMEOUT)
+    if not files.ipa or not files.info_plist or not files.icon or not files.icon_512:
+        return None
+
+    fnames = [files.ipa, files.icon, files.icon_512]
+    if _lazy('readahead', _readahead_call):
+        _step('readahead', map, _readahead, [os.path.join(path, f) for f in fnames])
+    from replication import describe_app
+    _step('digests', describe_app, path, _hashes())
+    _step('icons', map, lambda f: _small_asset_entry(path, f), fnames[1:])
+
+    environs = _warm_environs()
+    base_urls = set(_base_url(env)+name for env in environs)
+    base_urls.update(base+'/'+urllib.quote(name) for base in mirrors.mirrors.values())
+    bodies = _step('manifests', map, lambda url: _app_manifest(name, url, path, BACKGROUND_SCAN_TIMEOUT),
+                   sorted(base_urls))
+
+    def _page(env):
+        key = _page_key(name, st.st_mtime, env)
+        page = page_cache.get(key)
+        if page is None:
+            page = install_page(name, browser_check=False, browser_warning=key[2], server_url=_base_url(env))
+            page_cache.put(key, page)
+        return page
+    bodies += _step('pages', map, _page, environs)
+
+    _step('compressed', map, lambda entry: _encode(*entry),
+          [(body, coding) for body in bodies for coding in encoding.available()])
+    return timings
+
+def _warm_report(name, timings):
+    if timings is None:
+        return name+': not found or incomplete'
+    return '%s: %s (%.1fms)' % (name, ', '.join('%s %.1fms' % (label, seconds*1000)
+                                                for label, seconds in timings),
+                                sum(seconds for label, seconds in timings)*1000)
+
+def _warm_published(added, updated, removed):
+    # warming reads whole ipas, so it doesn't hold up the catalog refresh
+    def _warm(names):
+        for name in names:
+            try:
+                print 'warmed', _warm_report(name, warm_app(name))
+            except Exception, ex:
+                print 'could not warm', name, ex
+    if WARM_ON_PUBLISH and (added or updated):
+        thread = threading.Thread(target=_warm, args=(list(added)+list(updated),))
+        thread.setDaemon(True)
+        thread.start()
+
+def _describe_published(added, updated, removed):
+    if REPLICA_ROUTE:
+        _replicas().update(list(added)+list(updated), removed)
+
+def _catalog_names():
+    catalog.ready.wait()
+    return catalog.names
+
+def _follower(leader, prune):
+    from replication import Follower
+    return Follower(leader, prune=prune, locate=app_path, names=catalog.list_apps)
+
+def _page_request(f):
+    # runs a metadata route within page_gate, like install pages and
+    # manifests
+    @functools.wraps(f)
+    def _gated(*args, **kwargs):
+        if not page_gate.acquire():
+            return _overloaded()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            page_gate.release()
+    return _gated
+
+def start_background(leader=None):
+    global follower
+    setup()
+    catalog.start(CATALOG_REFRESH)
+    if _analytics():
+        _analytics().start(ANALYTICS_FLUSH)
+    if REPLICA_ROUTE:
+        _replicas().start(_catalog_names)
+
+    leader = leader or FOLLOW_LEADER
+    if leader and not follower:
+        follower = _follower(leader, SYNC_PRUNE)
+        follower.start(SYNC_INTERVAL)
+
+def _catalog_page():
+    start_background()
+    if not catalog.ready.wait(RETRY_AFTER):
+        raise _overloaded()
+
+    try:
+        limit = int(request.GET.get('limit', CATALOG_PAGE_SIZE))
+        apps, cursor = catalog.page(request.GET.get('prefix', ''),
+                                    request.GET.get('cursor'),
+                                    max(1, min(limit, CATALOG_MAX_PAGE_SIZE)))
+    except ValueError, ex:
+        raise HTTPError(400, str(ex))
+
+    base_url = _base_url()
+    def _listing(entry):
+        app_url = base_url+urllib.quote(entry['name'])
+        icon_url = None
+        if entry['icon']:
+            icon_url = app_url+'/'+urllib.quote(entry['icon'])
+        return {'name':entry['name'],
+                'bundle_id':entry['bundle_id'],
+                'version':entry['version'],
+                'published':entry['published'],
+                'url':app_url,
+                'icon_url':icon_url}
+
+    return [_listing(entry) for entry in apps], cursor
+
+@route(BASE_PATH+'/_icbm/catalog')
+@_page_request
+def catalog_json():
+    apps, cursor = _catalog_page()
+    response.content_type = 'application/json'
+    return _encode_response(json.dumps({'apps':apps, 'next':cursor,
+                                        'total':catalog.count(),
+                                        'generated':catalog.generated}))
+
+@route(BASE_PATH+'/_icbm/replica')
+@_page_request
+def replica():
+    if not REPLICA_ROUTE:
+        return HTTPError(404, 'replica route is disabled')
+    start_background()
+    # the apps are described in the background, never on a request thread
+    if not _replicas().ready.is_set():
+        return _overloaded()
+    return {'apps':_replicas().snapshot()}
+
+@route(BASE_PATH+'/_icbm/changes')
+def changes_feed():
+    try:
+        since = int(request.GET.get('since', 0))
+        wait = min(float(request.GET.get('wait', 0)), LONGPOLL_TIMEOUT)
+        limit = max(1, min(int(request.GET.get('limit', CHANGES_PAGE_SIZE)), CATALOG_MAX_PAGE_SIZE))
+    except ValueError, ex:
+        return HTTPError(400, str(ex))
+
+    if wait > 0 and watch_gate.acquire():
+        start_background()
+        try:
+            events, reset = changelog.wait(since, wait, limit)
+        finally:
+            watch_gate.release()
+    elif page_gate.acquire():
+        try:
+            events, reset = changelog.since(since, limit)
+        finally:
+            page_gate.release()
+    else:
+        return _overloaded()
+
+    if events:
+        cursor = events[-1]['seq']
+    elif reset:
+        cursor = changelog.last_seq
+    else:
+        cursor = since
+    return {'events':events, 'next':cursor, 'reset':reset}
+
+def _event_stream(name, cursor):
+    yield 'retry: %d\n\n' % (RETRY_AFTER*1000)
+    deadline = time.time() + STREAM_MAX_AGE
+    while time.time() < deadline:
+        events, reset = changelog.wait(cursor, STREAM_HEARTBEAT, CHANGES_PAGE_SIZE)
+        if reset:
+            cursor = changelog.last_seq
+            continue
+        if not events:
+            yield ': keepalive\n\n'
+            continue
+        for event in events:
+            cursor = event['seq']
+            if name and event['name'] != name:
+                continue
+            yield 'id: %d\nevent: %s\ndata: %s\n\n' % (event['seq'], event['type'],
+                                                       json.dumps(event))
+
+@route(BASE_PATH+'/_icbm/events')
+@route(BASE_PATH+'/_icbm/events/:name')
+def event_stream(name=None):
+    if name:
+        name = urllib.unquote(name)
+    try:
+        cursor = int(request.headers.get('Last-Event-ID') or changelog.last_seq)
+    except ValueError:
+        cursor = changelog.last_seq
+
+    if not stream_gate.acquire():
+        return _overloaded()
+
+    start_background()
+    response.content_type = 'text/event-stream'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return guard_body(_event_stream(name, cursor), stream_gate.release)
+
+@route(BASE_PATH+'/')
+@_page_request
+def catalog_page():
+    apps, cursor = _catalog_page()
+    next_url = None
+    if cursor:
+        query = dict(request.GET.items())
+        query['cursor'] = cursor
+        next_url = '?'+urllib.urlencode(query)
+    return _encode_response(template(CATALOG_TEMPLATE, apps=apps, next_url=next_url,
+                                     prefix=request.GET.get('prefix', ''), ctime=time.ctime,
+                                     timestamp=time.ctime(catalog.generated)))
+
+def _add_vary(header):
+    vary = response.headers.get('Vary')
+    response.headers['Vary'] = vary and vary+', '+header or header
+
+def _encode(body, accept_encoding):
+    # returns (body, content coding or None). Compressed bodies are cached by
+    # content, so every version of a page, manifest or listing is compressed
+    # once per encoding.
+    if not isinstance(body, basestring) or len(body) < COMPRESS_MIN_SIZE:
+        return body, None
+    coding = encoding.negotiate(accept_encoding)
+    if not coding:
+        return body, None
+
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    key = (hashlib.md5(body).digest(), len(body), coding)
+    data = encoded_cache.get(key)
+    if data is None:
+        data = encoding.compress(body, coding)
+        encoded_cache.put(key, data)
+    return data, coding
+
+def _encode_response(body):
+    _add_vary('Accept-Encoding')
+    body, coding = _encode(body, request.headers.get('Accept-Encoding'))
+    if coding:
+        response.headers['Content-Encoding'] = coding
+    return body
+
+def _lookup_failed(ex):
+    # the answer to a filesystem error other than the app not being there:
+    # not found if it can't be reached, 503 if the filer is in trouble
+    if ex.errno in (errno.EACCES, errno.EPERM, errno.ELOOP, errno.ENAMETOOLONG):
+        return HTTPError(404, 'not found')
+    print 'lookup failed:', ex
+    return _overloaded()
+
+def _overloaded():
+    err = HTTPError(503, 'server busy, try again shortly')
+    err.headers['Retry-After'] = str(RETRY_AFTER)
+    return err
+
+def _body_attr(resp):
+    # bottle renamed HTTPResponse.output to body in 0.10
+    return hasattr(resp, 'body') and 'body' or 'output'
+
+def _guard_response(resp, release):
+    attr = _body_attr(resp)
+    setattr(resp, attr, guard_body(getattr(resp, attr), release))
+    return resp
+
+def _throttle_response(resp, label):
+    attr = _body_attr(resp)
+    body = getattr(resp, attr)
+    if body and not isinstance(body, basestring):
+        client = request.environ.get('REMOTE_ADDR')
+        setattr(resp, attr, bandwidth.throttle(body, client, label))
+    return resp
+
+def _cached_asset(filename, st):
+    # returns (size, mtime, data, headers) for a small file, reading it only
+    # when it isn't cached or has changed since
+    entry = asset_cache.get(filename)
+    if entry and entry[:2] == (st.st_size, st.st_mtime):
+        return entry
+
+    with open(filename, 'rb') as f:
+        data = f.read()
+    import mimetypes
+    mimetype, coding = mimetypes.guess_type(filename)
+    headers = {'Content-Type':mimetype or 'application/octet-stream',
+               'Content-Length':str(len(data)),
+               'ETag':'"%s"' % hashlib.md5(data).hexdigest(),
+               'Last-Modified':time.strftime('%a, %d %b %Y %H:%M:%S GMT',
+                                             time.gmtime(st.st_mtime))}
+    if coding:
+        headers['Content-Encoding'] = coding
+    entry = (st.st_size, st.st_mtime, data, headers)
+    if len(data) == st.st_size:
+        asset_cache.put(filename, entry)
+    return entry
+
+def _counted_download(action):
+    return ANALYTICS_FILE and action.endswith('.ipa')
+
+def _small_asset_entry(path, action):
+    # downloads that are counted always go through serve_asset
+    if _counted_download(action):
+        return None
+    filename = os.path.join(path, action)
+    st = scanner.stat(filename)
+    if st and stat.S_ISREG(st.st_mode) and st.st_size <= ASSET_CACHE_MAX_FILE:
+        return _cached_asset(filename, st)
+
+def _small_asset(path, action):
+    # small files are answered from memory, without an asset slot: they go
+    # out in a single write
+    entry = _small_asset_entry(path, action)
+    if not entry:
+        return None
+
+    size, mtime, data, headers = entry
+    for header, value in headers.items():
+        response.headers[header] = value
+    if request.headers.get('If-None-Match') == headers['ETag']:
+        response.status = 304
+        del response.headers['Content-Length']
+        return ''
+    if request.method == 'HEAD':
+        return ''
+    return data
+
+def _build(name):
+    entry = catalog.get(name)
+    return entry and entry['version']
+
+def _count_install(name):
+    if ANALYTICS_FILE:
+        _analytics().count(name, _build(name), installs=1)
+
+def _count_download(resp, name):
+    # the transfer happens after we return, so what was sent is counted
+    # when the server closes the body
+    attr = _body_attr(resp)
+    body = getattr(resp, attr)
+    if not body or isinstance(body, basestring):
+        return resp
+    build = _build(name)
+    from analytics import counted
+    analytics = _analytics()
+    analytics.count(name, build, started=1, resumed=int('HTTP_RANGE' in request.environ))
+    def _done(sent, completed):
+        if completed is None:
+            analytics.count(name, build, unknown=1)
+        else:
+            analytics.count(name, build, completed=int(completed), bytes=sent)
+    setattr(resp, attr, counted(body, int(resp.headers['Content-Length']), _done,
+                                ANALYTICS_SENDFILE))
+    return resp
+
+def serve_asset(name, action, path=None):
+    try:
+        data = _small_asset(path or name, action)
+    except ScanTimeout:
+        return _overloaded()
+    except OSError, ex:
+        return _lookup_failed(ex)
+    if data is not None:
+        return data
+
+    if not asset_gate.acquire():
+        return _overloaded()
+
+    try:
+        resp = static_file(action, root=(path or name)+'/')
+        if _counted_download(action):
+            resp = _count_download(resp, name)
+        if bandwidth.enabled():
+            resp = _throttle_response(resp, name+'/'+action)
+    except:
+        asset_gate.release()
+        raise
+
+    # the transfer happens after we return, so the slot is held until the
+    # server closes the body
+    return _guard_response(resp, asset_gate.release)
+
+def _profile_dump():
+    response.content_type = 'text/plain'
+    return _sampler().collapsed()
+
+@route(BASE_PATH+'/_icbm/profile')
+def profile():
+    if not PROFILER_ROUTES:
+        return HTTPError(404, 'profiler routes are disabled')
+    return _profile_dump()
+
+@route(BASE_PATH+'/_icbm/profile/start', method='POST')
+def profile_start():
+    if not PROFILER_ROUTES:
+        return HTTPError(404, 'profiler routes are disabled')
+    if not _sampler().start():
+        return HTTPError(409, 'profiler already running')
+    return _sampler().stats()
+
+@route(BASE_PATH+'/_icbm/profile/stop', method='POST')
+def profile_stop():
+    if not PROFILER_ROUTES:
+        return HTTPError(404, 'profiler routes are disabled')
+    _sampler().stop()
+    return _profile_dump()
+
+def _memory_check(tracing=True):
+    # the error to return if a memory route cannot be used now, or None
+    if not MEMORY_ROUTES:
+        return HTTPError(404, 'memory routes are disabled')
+    if tracing and not _memory_tracer().running():
+        return HTTPError(409, 'memory tracing is not running')
+
+def _memory_limit():
+    # from the query string, or None if invalid
+    limit = request.GET.get('limit', '20')
+    if limit.isdigit():
+        return int(limit)
+
+@route(BASE_PATH+'/_icbm/memory')
+def memory():
+    if not MEMORY_ROUTES:
+        return HTTPError(404, 'memory routes are disabled')
+    return _memory_tracer().stats()
+
+@route(BASE_PATH+'/_icbm/memory/start', method='POST')
+def memory_start():
+    error = _memory_check(tracing=False)
+    if error:
+        return error
+    if not _memory_tracer().start():
+        return HTTPError(409, 'memory tracing already running')
+    return _memory_tracer().stats()
+
+@route(BASE_PATH+'/_icbm/memory/stop', method='POST')
+def memory_stop():
+    error = _memory_check(tracing=False)
+    if error:
+        return error
+    _memory_tracer().stop()
+    return _memory_tracer().stats()
+
+@route(BASE_PATH+'/_icbm/memory/snapshot/:name', method='POST')
+def memory_snapshot(name):
+    return _memory_check() or _memory_tracer().snapshot(name)
+
+@route(BASE_PATH+'/_icbm/memory/top/:name')
+def memory_top(name):
+    error, limit = _memory_check(tracing=False), _memory_limit()
+    if error or limit is None:
+        return error or HTTPError(400, 'bad limit')
+    try:
+        return {'snapshot':name, 'top':_memory_tracer().top(name, limit)}
+    except KeyError:
+        return HTTPError(404, 'no snapshot ' + name)
+
+@route(BASE_PATH+'/_icbm/memory/diff/:old/:new')
+def memory_diff(old, new):
+    error, limit = _memory_check(tracing=False), _memory_limit()
+    if error or limit is None:
+        return error or HTTPError(400, 'bad limit')
+    try:
+        return {'old':old, 'new':new, 'diff':_memory_tracer().diff(old, new, limit)}
+    except KeyError:
+        return HTTPError(404, 'no snapshot %s or %s' % (old, new))
+
+@route(BASE_PATH+'/_icbm/warm/:name', method='POST')
+def warm(name):
+    if not WARM_ROUTE:
+        return HTTPError(404, 'warm route is disabled')
+    timings = warm_app(name)
+    if timings is None:
+        return HTTPError(404, 'app not found or incomplete')
+    return {'name':name, 'steps':[[label, round(seconds*1000, 1)] for label, seconds in timings]}
+
+@route(BASE_PATH+'/_icbm/analytics/top')
+def analytics_top():
+    if not ANALYTICS_FILE:
+        return HTTPError(404, 'analytics are disabled')
+    from analytics import EVENTS
+    hours = request.GET.get('hours', '24')
+    by = request.GET.get('by', 'completed')
+    limit = request.GET.get('limit', '10')
+    if not hours.isdigit() or by not in EVENTS or not limit.isdigit():
+        return HTTPError(400, 'bad hours, by or limit')
+    since = time.time() - int(hours)*3600
+    # counts reach the database up to ANALYTICS_FLUSH seconds late
+    return {'since':int(since), 'by':by, 'last_flush':_analytics().last_flush,
+            'builds':_analytics().top(since, by=by, limit=int(limit))}
+
+@route(BASE_PATH+'/_icbm/stats')
+def stats():
+    return {'scanner':scanner.stats(),
+            'manifest_cache':manifest_cache.stats(),
+            'page_cache':page_cache.stats(),
+            'encoded_cache':encoded_cache.stats(),
+            'asset_cache':asset_cache.stats(),
+            'gates':{'asset':asset_gate.stats(), 'page':page_gate.stats(),
+                     'watch':watch_gate.stats(), 'stream':stream_gate.stats()},
+            'bandwidth':bandwidth.stats(),
+            'replication':follower and follower.stats(),
+            'profiler':sampler and sampler.stats(),
+            'memory':memory_tracer and memory_tracer.stats(),
+            'analytics':analytics and analytics.stats()}
+
+def _redirect_to_owner(name, action):
+    url = ring.location(name).rstrip('/')+'/'+urllib.quote(name)
+    if action:
+        url += '/'+urllib.quote(action)
+    if request.environ.get('QUERY_STRING'):
+        url += '?'+request.environ['QUERY_STRING']
+    redirect(url, 302)
+
 @route(BASE_PATH+'/:name/:action')
 @route(BASE_PATH+'/:name/')
 @route(BASE_PATH+'/:name')
@@ -158,53 +1216,206 @@ def index(name=None, action=None, path=None):
         return HTTPError(code=404)
 
     name = urllib.unquote(name)
+    try:
+        path = app_path(name, SCAN_TIMEOUT)
+        if not path:
+            _redirect_to_owner(name, action)
+        st = scanner.stat(path)
+    except ScanTimeout:
+        return _overloaded()
+    except OSError, ex:
+        return _lookup_failed(ex)
 
-    if not os.path.exists(name):
+    if not st:
         return HTTPError(code=404)
 
-    if not os.path.islink(name) and not os.path.isdir(name):
+    if not stat.S_ISDIR(st.st_mode):
         return HTTPError(code=404, output='not a directory')
 
-    if action == 'manifest.xml':
-        return install_manifest(name)
-    elif not action:
-        return install_page(name)
-    elif action:
+    # the manifest, which needs the directory listing, usually comes next
+    scanner.prefetch('listdir', [path])
+
+    if action and action != 'manifest.xml':
         print 'action:', action
-        return static_file(action, root=name+'/')
-    else:
-        return HTTPError(code=404)
+        return serve_asset(name, action, path)
+
+    if not page_gate.acquire():
+        return _overloaded()
+
+    try:
+        if action == 'manifest.xml':
+            manifest = install_manifest(name, path=path)
+            if isinstance(manifest, basestring):
+                _count_install(name)
+            return _encode_response(manifest)
+        else:
+            key = _page_key(name, st.st_mtime, request.environ)
+            page = page_cache.get(key)
+            if page is None:
+                page = install_page(name, browser_check=False, browser_warning=key[2])
+                page_cache.put(key, page)
+            return _encode_response(page)
+    except ScanTimeout:
+        return _overloaded()
+    except OSError, ex:
+        return _lookup_failed(ex)
+    finally:
+        page_gate.release()
+
+def _write_compressed(path, data):
+    # precompressed siblings for front-end servers (e.g. nginx gzip_static)
+    suffixes = {'gzip':'.gz', 'br':'.br'}
+    for coding in encoding.available():
+        with open(path+suffixes[coding], 'wb') as f:
+            f.write(encoding.compress(data, coding))
+        print 'wrote', os.path.basename(path+suffixes[coding])
+
+def ICBM():
+    '''The command line, its class made and optmatch imported on first use'''
+    return _lazy('command_line', _command_line)()
+
+def _command_line():
+    from optmatch import OptionMatcher, optmatcher, optset
+
+    class ICBM(OptionMatcher):
+        _profiler = None
+
+        def process(self, args, *more, **kwargs):
+            setup()
+            try:
+                return OptionMatcher.process(self, args, *more, **kwargs)
+            finally:
+                if self._profiler:
+                    self._profiler.disable()
+                    self._profiler.dump_stats(self._profile_path)
+                    print 'wrote profile to', self._profile_path
+                    self._profiler = None
+
+        @optset
+        def profile(self, profileOption=None):
+            '''writes cProfile stats for the command to PROFILE'''
+            if profileOption:
+                import cProfile
+                self._profile_path = profileOption
+                self._profiler = cProfile.Profile()
+                self._profiler.enable()
+
+        @optmatcher
+        def run_static(self, staticFlag, baseURL, name, ipaFile, plistFile, iconFile, icon512File,outputdir='.'):
+            _web()
+            outputdir += '/'
+            page = install_page(name, base_url = baseURL, browser_check=False)
+            index=open(outputdir+'index.html','w')
+            with index:
+                index.writelines(page)
+            print 'wrote index.html'
+            _write_compressed(outputdir+'index.html', page)
 
-from optmatch import OptionMatcher, optmatcher, optset
-class ICBM(OptionMatcher):
-    @optmatcher
-    def run_static(self, staticFlag, baseURL, name, ipaFile, plistFile, iconFile, icon512File,outputdir='.'):
-        import os
-        outputdir += '/'
-        index=open(outputdir+'index.html','w')
-        with index:
-            index.writelines(install_page(name, base_url = baseURL, browser_check=False))
-        print 'wrote index.html'
-
-        manifest=open(outputdir+'manifest.xml', 'w')
-        with manifest:
             icon_gloss = not _easy_match(iconFile, 'no_gloss')
-            manifest.writelines(install_manifest(   name,
-                                                    static=True,
-                                                    base_url=baseURL,
-                                                    ipa_file = ipaFile,
-                                                    plist_file = plistFile,
-                                                    icon_file = iconFile,
-                                                    icon512_file = icon512File,
-                                                    icon_gloss = icon_gloss))
-        print 'wrote manifest.xml'
-
-
-    @optmatcher
-    def run_bottle(self, host='localhost', port=8080):
-        import bottle
-        bottle.debug(True)
-        run(host=host, port=port, reloader=True)
+            plist = install_manifest(   name,
+                                        static=True,
+                                        base_url=baseURL,
+                                        ipa_file = ipaFile,
+                                        plist_file = plistFile,
+                                        icon_file = iconFile,
+                                        icon512_file = icon512File,
+                                        icon_gloss = icon_gloss)
+            manifest=open(outputdir+'manifest.xml', 'w')
+            with manifest:
+                manifest.writelines(plist)
+            print 'wrote manifest.xml'
+            _write_compressed(outputdir+'manifest.xml', plist)
+
+
+        @optmatcher
+        def run_sync(self, syncFlag, leader, pruneFlag=False):
+            published = _follower(leader, pruneFlag).sync()
+            print 'published', len(published), 'apps'
+
+        @optmatcher
+        def run_rebalance(self, rebalanceFlag, dryRunFlag=False):
+            # moves apps found in a local root that the ring assigns elsewhere
+            import shutil
+            if not ring:
+                print 'no STORAGE_ROOTS configured'
+                return
+            for root_id, location in ring.local_roots():
+                for name in sorted(_list_apps(location)):
+                    source = app_location(location, name, FANOUT_LEVELS, FANOUT_WIDTH)
+                    owner = ring.owner(name)
+                    if owner == root_id or name in _shipped_dirs(location) or not is_app_dir(source):
+                        continue
+                    target = app_path(name)
+                    if not target:
+                        print name, 'belongs on', ring.location(name), 'and has to be transferred there'
+                    elif os.path.exists(target):
+                        print name, 'is in both', location, 'and', ring.roots[owner], 'skipping'
+                    else:
+                        print 'moving', name, 'from', location, 'to', ring.roots[owner]
+                        if not dryRunFlag:
+                            if not os.path.isdir(os.path.dirname(target)):
+                                os.makedirs(os.path.dirname(target))
+                            shutil.move(source, target)
+
+        @optmatcher
+        def run_migrate(self, migrateLayoutFlag, levelsOptionInt=2, widthOptionInt=2, dryRunFlag=False):
+            def _report(name, path):
+                print dryRunFlag and 'would move' or 'moved', name, 'to', path
+            for root in local_roots():
+                moved = migrate(root, levelsOptionInt, widthOptionInt, _report,
+                                _shipped_dirs(root), dryRunFlag)
+                if dryRunFlag:
+                    print moved, 'apps to migrate in', root
+                    continue
+                print 'migrated', moved, 'apps in', root
+            if (FANOUT_LEVELS, FANOUT_WIDTH) != (levelsOptionInt, widthOptionInt):
+                print 'now set FANOUT_LEVELS=%d and FANOUT_WIDTH=%d' % (levelsOptionInt, widthOptionInt)
+
+        @optmatcher
+        def run_warm(self, warmFlag, serverOption=None, *names):
+            # without a server the caches filled are this process', and only
+            # the kernel's page cache outlives it
+            import urllib2
+            _web()
+            status = 0
+            for name in names:
+                if serverOption:
+                    url = serverOption.rstrip('/')+'/_icbm/warm/'+urllib.quote(name)
+                    try:
+                        reply = json.load(urllib2.urlopen(urllib2.Request(url, data='')))
+                        print _warm_report(name, [(label, ms/1000.0) for label, ms in reply['steps']])
+                    except urllib2.HTTPError, ex:
+                        print name+':', ex
+                        status = 1
+                else:
+                    timings = warm_app(name)
+                    print _warm_report(name, timings)
+                    if timings is None:
+                        status = 1
+            return status
+
+        @optmatcher
+        def run_daemon(self, daemonFlag, socketOption=None, workersOptionInt=DAEMON_WORKERS):
+            import icbmd
+            icbmd.serve(ICBM, socketOption or icbmd.SOCKET, workersOptionInt)
+
+        @optmatcher
+        def run_bottle(self, host='localhost', port=8080, followOption=None):
+            global SERVER_THREADS
+            from bottle import debug, run
+            setup_server()
+            debug(True)
+            # bottle's default server handles one request at a time, so nothing
+            # may wait on it
+            SERVER_THREADS = 1
+            _size_gates()
+            # with the reloader the parent process only watches for changes,
+            # the background work belongs in the child that serves requests
+            if os.environ.get('BOTTLE_CHILD'):
+                start_background(followOption)
+            run(host=host, port=port, reloader=True)
+
+    return ICBM
 
 if __name__ == '__main__':
     sys.exit(ICBM().process(sys.argv))
@@ -0,0 +1,174 @@
+'''icbmd - runs icbm.py commands in a warm daemon
+
+`python icbm.py --daemon` listens on a Unix socket with the ICBM modules
+already imported and its command line handlers compiled. Each command sent
+to it runs in a process forked from the daemon, in the client's directory
+and environment, up to a number of workers at a time; its output and exit
+status are streamed back as it runs.
+
+The client is this module, used exactly like icbm.py:
+
+    python icbmd.py --static http://example.com/AwesomeApp AwesomeApp ...
+
+When no daemon is listening, the client runs the command itself.
+ICBM_SOCKET selects another socket for both.
+'''
+
+import json
+import os
+import signal
+import socket
+import sys
+import tempfile
+import traceback
+
+SOCKET = os.environ.get('ICBM_SOCKET') or os.path.join(
+    tempfile.gettempdir(), 'icbm-%d.sock' % os.getuid())
+
+# a reply is a sequence of frames: "o <size>\n<data>" for stdout,
+# "e <size>\n<data>" for stderr, and a final "x <status>\n"
+
+class _Channel(object):
+    '''File-like object sending what is written as frames of one type'''
+    def __init__(self, conn, kind):
+        self.conn = conn
+        self.kind = kind
+        self.pending = []
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.pending.append(data)
+        if '\n' in data:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        data = ''.join(self.pending)
+        self.pending = []
+        if data:
+            self.conn.sendall('%s %d\n%s' % (self.kind, len(data), data))
+
+    def isatty(self):
+        return False
+
+def _exit_status(code):
+    # the status sys.exit(code) would give
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print >>sys.stderr, code
+    return 1
+
+def _run(conn, command_class):
+    # json gives back unicode, commands expect the bytes they were given
+    request = json.loads(conn.makefile('rb').readline())
+    utf8 = lambda value: value.encode('utf-8')
+    os.chdir(utf8(request['cwd']))
+    os.environ.clear()
+    os.environ.update((utf8(k), utf8(v)) for k, v in request['env'].items())
+    argv = map(utf8, request['argv'])
+    sys.stdout, sys.stderr = _Channel(conn, 'o'), _Channel(conn, 'e')
+    try:
+        status = _exit_status(command_class().process(argv))
+    except SystemExit, e:
+        status = _exit_status(e.code)
+    except:
+        traceback.print_exc()
+        status = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    conn.sendall('x %d\n' % status)
+
+def _listen(path):
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(path)
+        except socket.error:
+            os.unlink(path) # left behind by a daemon that died
+        else:
+            raise RuntimeError('a daemon is already listening on ' + path)
+        finally:
+            probe.close()
+    sock = socket.socket(socket.AF_UNIX)
+    # created private, so no one else can connect between bind and chmod
+    umask = os.umask(0077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+    os.chmod(path, 0600)
+    sock.listen(64)
+    return sock
+
+def serve(command_class, path=SOCKET, workers=4):
+    '''Runs the commands received on the socket at path with
+    command_class().process(argv), in up to workers processes at a time'''
+    command_class().getUsage() # compiles the handlers once, before forking
+    sock = _listen(path)
+    print 'listening on', path
+    sys.stdout.flush()
+    children = set()
+    # so that a plain kill removes the socket too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            while children:
+                pid = os.waitpid(-1, len(children) < workers and os.WNOHANG or 0)[0]
+                if not pid:
+                    break
+                children.discard(pid)
+            conn = sock.accept()[0]
+            pid = os.fork()
+            if not pid:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                sock.close()
+                try:
+                    _run(conn, command_class)
+                finally:
+                    os._exit(0)
+            conn.close()
+            children.add(pid)
+    finally:
+        sock.close()
+        os.unlink(path)
+
+def _receive(conn):
+    # relays the reply frames, returning the exit status
+    reply = conn.makefile('rb')
+    while True:
+        header = reply.readline()
+        if not header:
+            print >>sys.stderr, 'icbm daemon: command ended without a status'
+            return 1
+        kind, value = header.split()
+        if kind == 'x':
+            return int(value)
+        out = kind == 'o' and sys.stdout or sys.stderr
+        out.write(reply.read(int(value)))
+        out.flush()
+
+def client(argv, path=SOCKET):
+    '''Runs an icbm.py command line in the daemon, or here if there is
+    none, returning its exit status'''
+    argv = ['icbm.py'] + argv[1:]
+    conn = socket.socket(socket.AF_UNIX)
+    try:
+        conn.connect(path)
+    except socket.error:
+        import icbm
+        return icbm.ICBM().process(argv)
+    try:
+        conn.sendall(json.dumps({'argv':argv, 'cwd':os.getcwd(),
+                                 'env':dict(os.environ)}) + '\n')
+        return _receive(conn)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    sys.exit(client(sys.argv))
@@ -0,0 +1,165 @@
+'''layout - where app directories live inside a storage root
+
+The flat layout keeps every app as a direct child of the root. The fan-out
+layout shards apps into `levels` nested directories named after the first
+characters of the md5 of the app name (ab/cd/AwesomeApp for two levels of
+width two), so no directory grows beyond a few hundred entries.
+
+A root that has been migrated holds a LAYOUT_FILE recording the fan-out
+parameters, plus the apps still to be moved while a migration is running.
+'''
+
+import hashlib
+import json
+import os
+import string
+
+LAYOUT_FILE = '.icbm-layout'
+
+def fanout_dirs(name, levels, width):
+    digest = hashlib.md5(name).hexdigest()
+    return [digest[i*width:(i+1)*width] for i in range(levels)]
+
+def app_location(root, name, levels=0, width=2, exists=os.path.exists):
+    '''Returns the path of an app in root. Apps not moved yet by a running
+    migration are still found at their flat location.
+    Param exists(path) is used to check where the app is, so that servers
+    can look it up without blocking on the filesystem.'''
+    flat = os.path.join(root, name)
+    if not levels:
+        return flat
+    sharded = os.path.join(root, *(fanout_dirs(name, levels, width) + [name]))
+    if not exists(sharded) and exists(flat):
+        return flat
+    return sharded
+
+def _is_fanout_dir(fname, width):
+    return len(fname) == width and not fname.strip(string.hexdigits.lower())
+
+def _app_dirs(path):
+    return [n for n in os.listdir(path)
+            if not n.startswith('.') and os.path.isdir(os.path.join(path, n))]
+
+def is_app_dir(path):
+    '''Whether path holds an app: an ipa and an info plist'''
+    try:
+        fnames = os.listdir(path)
+    except OSError:
+        return False
+    exts = [(os.path.splitext(f)[1], f.lower()) for f in fnames]
+    return any(ext == '.ipa' for ext, f in exts) and \
+        any(ext == '.plist' and 'info' in f for ext, f in exts)
+
+def _flat_apps(root, width, exclude, layout):
+    # the apps a migration has to move. Other directories, such as the ones
+    # ICBM itself ships when it keeps apps next to it, are left alone, and
+    # once a root is migrated, directories named like fan-out directories
+    # are those.
+    return sorted(n for n in _app_dirs(root)
+                  if n not in exclude and is_app_dir(os.path.join(root, n))
+                  and not (layout and _is_fanout_dir(n, width)))
+
+def list_apps(root, levels=0, width=2, subdirs=None, prefetch=None):
+    '''Lists the names of the app directories in root.
+    Param subdirs(path) lists the non-hidden subdirectories of path.
+    Param prefetch(paths), if given, is told about the fan-out directories
+        that are about to be listed, so their listings can be started early.
+    '''
+    subdirs = subdirs or _app_dirs
+    if not levels:
+        return subdirs(root)
+
+    names = []
+    pending = set(read_layout(root).get('pending', []))
+    def _walk(path, depth):
+        children = subdirs(path)
+        if prefetch and depth < levels:
+            prefetch([os.path.join(path, c) for c in children if _is_fanout_dir(c, width)])
+        for fname in children:
+            if depth == 0 and fname in pending and not _is_fanout_dir(fname, width):
+                # an app at its flat location, waiting to be migrated
+                names.append(fname)
+            elif depth == levels:
+                names.append(fname)
+            elif _is_fanout_dir(fname, width):
+                _walk(os.path.join(path, fname), depth+1)
+    _walk(root, 0)
+    return names
+
+def read_layout(root):
+    try:
+        with open(os.path.join(root, LAYOUT_FILE)) as f:
+            layout = json.load(f)
+    except IOError:
+        return {}
+    layout['pending'] = [n.encode('utf-8') for n in layout['pending']]
+    return layout
+
+def _write_layout(root, layout):
+    path = os.path.join(root, LAYOUT_FILE)
+    with open(path+'.tmp', 'w') as f:
+        json.dump(layout, f)
+    os.rename(path+'.tmp', path)
+
+def migrate(root, levels, width=2, report=None, exclude=(), dry_run=False):
+    '''Moves every app in a flat root into the fan-out layout, in place.
+    The list of apps to move is saved first, so an interrupted migration
+    can simply be run again. Returns the number of apps moved.
+    Only directories holding an app (see is_app_dir) and not in exclude
+    are moved. With dry_run, report(name, path) is told about each move
+    but nothing is changed.'''
+    layout = read_layout(root)
+    if layout.get('levels') and (layout['levels'], layout['width']) != (levels, width):
+        raise ValueError('%s already uses a %d level, width %d layout'
+                         % (root, layout['levels'], layout['width']))
+    pending = layout.get('pending', [])
+    if not layout.get('staged'):
+        # already migrated: pick up any apps dropped in flat since
+        pending = pending + [n for n in _flat_apps(root, width, exclude, layout)
+                             if n not in pending]
+    if dry_run:
+        for name in pending:
+            if report:
+                report(name, os.path.join(root, *(fanout_dirs(name, levels, width) + [name])))
+        return len(pending)
+
+    if not layout:
+        layout = {'levels':levels, 'width':width}
+    layout['pending'] = pending
+    _write_layout(root, layout)
+
+    def _staged(name):
+        return os.path.join(root, '.%s.migrating' % name)
+
+    if not layout.get('staged'):
+        # apps named like a fan-out directory ('ab') would have other apps
+        # moved inside them, so get them out of the way first
+        for name in layout['pending']:
+            if _is_fanout_dir(name, width) and os.path.isdir(os.path.join(root, name)):
+                os.rename(os.path.join(root, name), _staged(name))
+        layout['staged'] = True
+        _write_layout(root, layout)
+
+    moved = 0
+    for name in list(layout['pending']):
+        source = os.path.join(root, name)
+        if os.path.isdir(_staged(name)):
+            source = _staged(name)
+        parent = os.path.join(root, *fanout_dirs(name, levels, width))
+        if source != os.path.join(root, name) or not _is_fanout_dir(name, width):
+            if os.path.isdir(source):
+                if not os.path.isdir(parent):
+                    os.makedirs(parent)
+                os.rename(source, os.path.join(parent, name))
+                moved += 1
+                if report:
+                    report(name, os.path.join(parent, name))
+        layout['pending'].remove(name)
+        if len(layout['pending']) % 100 == 0:
+            # an app missing from its flat location has already been moved,
+            # so the layout file only needs saving now and then
+            _write_layout(root, layout)
+
+    del layout['staged']
+    _write_layout(root, layout)
+    return moved
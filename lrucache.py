@@ -0,0 +1,64 @@
+'''lrucache - small thread-safe LRU cache'''
+
+import collections
+import threading
+
+class LRUCache(object):
+    '''Holds up to max_entries values, evicting the least recently used.
+    With max_bytes, the total sizeof(value) is kept under that budget too.
+    '''
+    def __init__(self, max_entries, max_bytes=None, sizeof=len):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.max_bytes and self.sizeof(value) or 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = value
+            self.size += size
+            while (len(self._items) > self.max_entries or
+                   (self.max_bytes and self.size > self.max_bytes)):
+                self._remove(next(iter(self._items)))
+
+    def pop(self, key):
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        value = self._items.pop(key)
+        if self.max_bytes:
+            self.size -= self.sizeof(value)
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        return {'entries':len(self._items), 'bytes':self.size,
+                'hits':self.hits, 'misses':self.misses}
@@ -0,0 +1,127 @@
+'''memtrace - object counts for a running server
+
+A MemoryTracer keeps named snapshots of the objects the garbage collector
+tracks, counted and sized by type, with the peak resident size when each
+was taken, so the types that take the most memory, and how they grew
+between two snapshots, can be listed. That misses strings, numbers and
+memory held outside Python objects, and sizes are shallow, but it shows
+which kinds of objects pile up.
+'''
+
+import collections
+import gc
+import sys
+import threading
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def _maxrss():
+    # peak resident size in KB (Linux) or bytes (OS X), or None
+    return resource and resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _type_name(obj):
+    cls = type(obj)
+    if cls.__name__ == 'instance':
+        cls = obj.__class__ # old-style classes
+    if cls.__module__ == '__builtin__':
+        return cls.__name__
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+class _TypeStat(object):
+    def __init__(self, where, size=0, count=0):
+        self.where = where
+        self.size = size
+        self.count = count
+
+
+class _TypeSnapshot(object):
+    '''The objects gc tracks, as {type name:_TypeStat}, and the peak
+    resident size when taken'''
+    def __init__(self):
+        self.types = {}
+        for obj in gc.get_objects():
+            name = _type_name(obj)
+            stat = self.types.get(name)
+            if stat is None:
+                stat = self.types[name] = _TypeStat(name)
+            stat.size += sys.getsizeof(obj, 0)
+            stat.count += 1
+        self.maxrss = _maxrss()
+
+    def top(self, limit):
+        stats = sorted(self.types.values(), key=lambda s: (-s.size, s.where))
+        return [{'where':s.where, 'size':s.size, 'count':s.count} for s in stats[:limit]]
+
+    def diff(self, old, limit):
+        ret = []
+        for name in set(self.types) | set(old.types):
+            new_stat = self.types.get(name) or _TypeStat(name)
+            old_stat = old.types.get(name) or _TypeStat(name)
+            ret.append({'where':name, 'size':new_stat.size, 'count':new_stat.count,
+                        'size_diff':new_stat.size - old_stat.size,
+                        'count_diff':new_stat.count - old_stat.count})
+        ret.sort(key=lambda e: (-abs(e['size_diff']), -e['size'], e['where']))
+        return ret[:limit]
+
+class MemoryTracer(object):
+    def __init__(self, max_snapshots=8):
+        '''
+        Param max_snapshots is how many snapshots are kept; taking one more
+            drops the oldest.
+        '''
+        self.max_snapshots = max_snapshots
+        self._snapshots = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # there is nothing to switch on; running only decides whether
+        # snapshots are taken
+        self._running = False
+
+    def running(self):
+        return self._running
+
+    def start(self):
+        '''Starts afresh; returns False if already running'''
+        with self._lock:
+            if self._running:
+                return False
+            self._snapshots.clear()
+            self._running = True
+            return True
+
+    def stop(self):
+        '''Stops; the snapshots already taken are kept'''
+        self._running = False
+
+    def snapshot(self, name):
+        '''Takes a snapshot under the given name, replacing any older one'''
+        snapshot = _TypeSnapshot()
+        ret = {'name':name, 'objects':sum(s.count for s in snapshot.types.values()),
+               'size':sum(s.size for s in snapshot.types.values()),
+               'maxrss':snapshot.maxrss}
+        with self._lock:
+            self._snapshots.pop(name, None)
+            self._snapshots[name] = snapshot
+            while len(self._snapshots) > self.max_snapshots:
+                self._snapshots.popitem(last=False)
+        return ret
+
+    def _get(self, name):
+        # raises KeyError for unknown snapshots
+        with self._lock:
+            return self._snapshots[name]
+
+    def top(self, name, limit=20):
+        '''The types taking the most memory in a snapshot'''
+        return self._get(name).top(limit)
+
+    def diff(self, old, new, limit=20):
+        '''The types whose memory changed the most between two snapshots'''
+        return self._get(new).diff(self._get(old), limit)
+
+    def stats(self):
+        return {'running':self.running(), 'maxrss':_maxrss(),
+                'snapshots':list(self._snapshots.keys())}
@@ -0,0 +1,65 @@
+'''mirrors - choosing which host clients download app files from
+
+A MirrorSelector knows a set of named mirrors (base URLs serving app files
+as <base>/<app name>/<file>) and which client networks each one is closest
+to. A client can also ask for a mirror by name; ORIGIN asks for this server.
+'''
+
+import socket
+import struct
+
+ORIGIN = 'origin'
+
+def _parse_address(address):
+    # returns (family, address as an integer)
+    for family in socket.AF_INET, socket.AF_INET6:
+        try:
+            packed = socket.inet_pton(family, address)
+        except (socket.error, ValueError):
+            continue
+        if family == socket.AF_INET:
+            return family, struct.unpack('!I', packed)[0]
+        high, low = struct.unpack('!QQ', packed)
+        return family, (high << 64) | low
+    raise ValueError('invalid address ' + address)
+
+def parse_network(cidr):
+    '''Parses "10.1.0.0/16" into (family, network, mask)'''
+    address, _, bits = cidr.partition('/')
+    family, network = _parse_address(address)
+    width = family == socket.AF_INET and 32 or 128
+    bits = bits and int(bits) or width
+    mask = ((1 << bits) - 1) << (width - bits)
+    return family, network & mask, mask
+
+
+class MirrorSelector(object):
+    def __init__(self, mirrors, networks):
+        '''
+        Param mirrors maps mirror names to base URLs.
+        Param networks is a list of (cidr, mirror name) pairs, matched in
+            order.
+        '''
+        self.mirrors = dict((n, base.rstrip('/')) for n, base in mirrors.items())
+        self.networks = []
+        for cidr, name in networks:
+            if name not in self.mirrors:
+                raise ValueError('unknown mirror %s for %s' % (name, cidr))
+            self.networks.append((parse_network(cidr), name))
+
+    def select(self, client_address, requested=None):
+        '''Returns (name, base URL) of the mirror for a client, or
+        (None, None) to download from this server'''
+        if requested == ORIGIN:
+            return None, None
+        if requested in self.mirrors:
+            return requested, self.mirrors[requested]
+        if client_address and self.networks:
+            try:
+                family, address = _parse_address(client_address)
+            except ValueError:
+                return None, None
+            for (net_family, network, mask), name in self.networks:
+                if family == net_family and address & mask == network:
+                    return name, self.mirrors[name]
+        return None, None
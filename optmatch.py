@@ -3,9 +3,24 @@ Support usual GNU/Unix conventions, but not exclusively
 
 Author:  Luis M. Pena <dr.lu@coderazzi.net>
 Site:    www.coderazzi.net/python/optmatch
+
+Vendored in icbm from 0.8.7, with local changes:
+  - handler tables are compiled once per class and configuration, for
+    the last few configurations of each class
+  - the arguments are tokenized once, however many matchers go through
+    them, and outside GNU mode the matchers are tried side by side in one
+    pass over the command line, each dropped when it fails. This is not
+    linear time: every matcher still handles the arguments it accepts, so
+    the worst case is matchers x arguments, as before. In GNU mode the
+    matchers are still tried one after another, each reading the command
+    line as the previous one left it
+  - option names are resolved through compiled tables and a trie, and
+    unambiguous abbreviations are accepted if enabled (off by default)
+  - usage strings are cached until the options change
+  - @file arguments are expanded, lazily, if enabled (off by default)
 """
 
-__version__ = '0.8.7'
+__version__ = '0.8.7+icbm'
 
 __all__ = ['optset', 'optmatcher',
            'OptionMatcher', 'OptionMatcherException', 'UsageException']
@@ -100,17 +115,17 @@ class Decoration(object):
     @staticmethod
     def getDecoratedMethods(instance, definedAsCommon):
         #Returns the methods decorated with optmatcher or optset -depending
-        # on definedAsCommon, priority sorted
+        # on definedAsCommon-, priority sorted, as (attribute name, method)
         functionsAndPriorities = []
         for att in dir(instance):
             f = getattr (instance, att)
             if definedAsCommon == hasattr(f, 'optset'):
                 info, group, priority = Decoration.parseDecoration(f)
                 if info:
-                    functionsAndPriorities.append((priority or 0, f))
+                    functionsAndPriorities.append((priority or 0, att, f))
         #sort now by inverse priority, and return just the functions
         functionsAndPriorities.sort(key=lambda x: -x[0])
-        return [f for (p, f) in functionsAndPriorities]    
+        return [(att, f) for (p, att, f) in functionsAndPriorities]    
 
 
 class UsageMode(object):
@@ -150,6 +165,155 @@ class UsageMode(object):
         return ' '
 
 
+def expandArgumentFiles(args):
+    '''Yields the given arguments, replacing each @file argument that names
+    an existing file with the lines in the file (empty lines are skipped).
+    The files are read as the arguments are consumed.'''
+    for i, arg in enumerate(args):
+        if i and arg.startswith('@') and os.path.isfile(arg[1:]):
+            with open(arg[1:]) as f:
+                for line in f:
+                    line = line.rstrip('\r\n')
+                    if line:
+                        yield line
+        else:
+            yield arg
+
+
+class ArgumentStream(object):
+    '''Internal class, the command line arguments after expanding the
+    argument files, read as they are needed. Only the arguments not yet 
+    trimmed are kept'''
+    
+    def __init__(self, args):
+        self.source = expandArgumentFiles(args)
+        self.window = {}
+        self.count = 0 #the number of arguments read so far
+        
+    def exists(self, index):
+        '''Returns True if there is an argument at the given index'''
+        while index >= self.count and self.source:
+            try:
+                self.window[self.count] = self.source.next()
+                self.count += 1
+            except StopIteration:
+                self.source = None
+        return index < self.count
+        
+    def __getitem__(self, index):
+        self.exists(index)
+        return self.window[index]
+    
+    def trim(self, index):
+        '''Drops the arguments before the given index'''
+        for each in [i for i in self.window if i < index]:
+            del self.window[each]
+            
+
+class ArgumentTokens(object):
+    '''Internal class, the tokenized command line arguments
+    Each argument is split into its option prefix, name and value only 
+       once, however many matchers go through the command line. As under
+       gnu mode an argument is tokenized differently after the first non 
+       option argument, tokens are cached per (position, canBeOption).
+    With argument files, the arguments are streamed: the tokens (and the
+       arguments) behind every command line going through them are dropped
+       once there are more than WINDOW.
+       Invalid arguments are not cached, they raise UsageException
+    '''
+    
+    WINDOW = 1024
+    
+    def __init__(self, args, mode, gnuMode, argumentFiles=False):
+        '''param args: the list of arguments to handle (first dismissed)
+        param argumentFiles: True to expand the @file arguments'''
+        #reShort is hardcoded to '-' if the option is defined as '--'
+        self.reShort = mode.getopt
+        self.reOption = mode.option
+        self.reSeparation = re.compile('(.+?)' + mode.assigner + '(.+)$')
+        self.original = args
+        self.stream = None
+        if argumentFiles and filter(lambda x: x.startswith('@'), args[1:]):
+            self.stream = ArgumentStream(args)
+        self.args = self.stream or args
+        self.gnuMode = gnuMode
+        self.tokens = {}
+        self.commandLines = set() #those going through the arguments
+        
+    def exists(self, index):
+        '''Returns True if there is an argument at the given index'''
+        if self.stream:
+            return self.stream.exists(index)
+        return index < len(self.args)
+    
+    def size(self):
+        '''Returns the number of arguments, or of those read so far'''
+        if self.stream:
+            return self.stream.count
+        return len(self.args)
+    
+    def iterate(self):
+        '''Returns a new iterator over all the arguments'''
+        if self.stream:
+            return expandArgumentFiles(self.original)
+        return iter(self.args)
+        
+    def separate(self, what):
+        '''Separates the passed string into name and value.
+        Returns a tuple (status, name, value) where status is True
+           if the string was separated
+        '''
+        m = self.reSeparation.match(what)
+        return m and (True, m.group(1), m.group(2)) or (False, what, None)
+        
+    def get(self, index, canBeOption):
+        '''Returns the token for the argument at the given index, as a tuple
+        (arg, option, isShort, name, value, split, canBeOption), where the 
+        last element is the canBeOption value for the next argument'''
+        key = index, canBeOption
+        try:
+            return self.tokens[key]
+        except KeyError:
+            if self.stream and len(self.tokens) > self.WINDOW:
+                self._trim()
+            token = self.tokens[key] = self._tokenize(index, canBeOption)
+            return token
+        
+    def _trim(self):
+        #drops the tokens and arguments behind every command line
+        positions = [each.getIndex() for each in self.commandLines 
+                     if not each.finished()]
+        if positions:
+            low = min(positions)
+            for each in [key for key in self.tokens if key[0] < low]:
+                del self.tokens[each]
+            self.stream.trim(low)
+    
+    def _tokenize(self, index, canBeOption):
+        whole = arg = self.args[index]
+        option, isShort, split = False, False, False
+        isOption = whole.startswith(self.reOption)
+        if canBeOption:
+            if isOption:  #normal (long) option
+                arg = whole[len(self.reOption):]
+                option = True
+            elif self.reShort and whole[0] == '-':
+                arg = whole[1:]
+                option, isShort = True, True
+            else:
+                canBeOption = not self.gnuMode
+        elif isOption or (self.reShort and whole[0] == '-'):
+            raise UsageException('Unexpected argument ' + whole + 
+                                 ' after non option arguments')
+        if not arg:
+            raise UsageException('Unexpected argument ' + whole)
+        if isShort:         
+            name, value = arg[0], arg[1:]
+        else:
+            split, name, value = self.separate(arg)
+        return whole, option, isShort, name, value, split, canBeOption
+
+
 class CommandLine(object):
     '''Internal class to handle the Command Line arguments
     This class is used by the handlers to iterate through the arguments in
@@ -167,25 +331,38 @@ class CommandLine(object):
     #   option : Bool, true if the current argument is an option
     #   isShort: Bool, true if the current arg is a short option
        
-    def __init__(self, args, mode, gnuMode):
+    def __init__(self, args, mode, gnuMode, tokens=None, argumentFiles=False,
+                 canBeOption=True):
         '''param args: the list of arguments to handle (first dismissed)'''
-        #reShort is hardcoded to '-' if the option is defined as '--'
-        self.reShort = mode.getopt
-        self.reOption = mode.option
-        self.reSeparation = re.compile('(.+?)' + mode.assigner + '(.+)$')
-        self.args = args
-        self.gnuMode = gnuMode
-        self.canBeOption = True #used for gnuMode  
+        self.tokens = tokens or ArgumentTokens(args, mode, gnuMode, 
+                                               argumentFiles)
+        self.tokens.commandLines.add(self)
+        self.canBeOption = canBeOption #used for gnuMode  
         self.reset()
         
+    def copy(self, canBeOption=True):
+        '''Returns a new command line, at the first argument, sharing the
+        already tokenized arguments. Under gnu mode, canBeOption is False 
+        to read them as found after a non option argument'''
+        return CommandLine(None, None, None, self.tokens, 
+                           canBeOption=canBeOption)
+        
+    def close(self):
+        '''Reports that the command line is not going to be used anymore'''
+        self.tokens.commandLines.discard(self)
+        
     def reset(self):
         self.next = 1
-        if len(self.args) > 1:
+        if self.tokens.exists(1):
             self._next()
             
+    def getIndex(self):
+        '''Returns the index of the current argument'''
+        return self.next - 1
+            
     def getPosition(self):
         if self.finished():
-            return len(self.args), 0
+            return self.tokens.size(), 0
         inShort = len(self.arg)
         if self.value:
             inShort -= len(self.value)
@@ -199,15 +376,14 @@ class CommandLine(object):
         Returns a tuple (status, name, value) where status is True
            if the string was separated
         '''
-        m = self.reSeparation.match(what)
-        return m and (True, m.group(1), m.group(2)) or (False, what, None)
+        return self.tokens.separate(what)
         
     def setArgHandled(self):
         '''Reports that the current argument has been handled.
         It returns True if there are no more arguments to handle or the 
             next argument is an option
         '''
-        if self.next >= len(self.args):
+        if not self.tokens.exists(self.next):
             self.next = 1
         return (self.next == 1) or self._next()
             
@@ -220,29 +396,11 @@ class CommandLine(object):
     
     def _next(self):
         '''Handles the next argument, returning True if it is an option'''
-        self.arg = self.args[self.next]
-        arg = self.arg #...
+        key = self.next, self.canBeOption
+        (self.arg, self.option, self.isShort, self.name, self.value, 
+            self.split, self.canBeOption) = (self.tokens.tokens.get(key) or 
+                                             self.tokens.get(*key))
         self.next += 1
-        self.option, self.isShort = False, False
-        option = self.arg.startswith(self.reOption)
-        if self.canBeOption:
-            if option:  #normal (long) option
-                arg = self.arg[len(self.reOption):]
-                self.option = True
-            elif self.reShort and self.arg[0] == '-':
-                arg = self.arg[1:]
-                self.option, self.isShort, self.split = True, True, False
-            else:
-                self.canBeOption = not self.gnuMode
-        elif option or (self.reShort and self.arg[0] == '-'):
-            raise UsageException('Unexpected argument ' + self.arg + 
-                                 ' after non option arguments')
-        if not arg:
-            raise UsageException('Unexpected argument ' + self.arg)         
-        if self.isShort:         
-            self.name, self.value = arg[0], arg[1:]
-        else:
-            self.split, self.name, self.value = self.separate(arg)
         return self.option
 
 
@@ -344,9 +502,59 @@ class PrefixInfo(OptionInfo):
     '''Prefixes are flags that add a suffix: -m MODE, instead of -m, i.e. '''
     
 
+class NameTrie(object):
+    '''Internal class, a trie over the long option names of a matcher.
+    Each name is mapped to its (kind, index) target
+    '''
+    
+    def __init__(self):
+        self.root = {}
+        
+    def add(self, name, target):
+        node = self.root
+        for c in name:
+            node = node.setdefault(c, {})
+        node[None] = name, target
+        
+    def splitPrefix(self, name, kind):
+        '''Returns the tuple (index, rest) for the longest name of the given
+        kind starting the given name, or (None, None) if not found'''
+        node, ret = self.root, (None, None)
+        for i, c in enumerate(name):
+            node = node.get(c)
+            if node is None:
+                break
+            entry = node.get(None)
+            if entry and entry[1][0] == kind:
+                ret = entry[1][1], name[i + 1:]
+        return ret
+    
+    def complete(self, name):
+        '''Returns the (name, target) entries for all the names starting
+        with the given one'''
+        node = self.root
+        for c in name:
+            node = node.get(c)
+            if node is None:
+                return []
+        ret, pending = [], [node]
+        while pending:
+            node = pending.pop()
+            for c, each in node.items():
+                if c is None:
+                    ret.append(each)
+                else:
+                    pending.append(each)
+        return ret
+    
+
 class OptMatcherInfo(object):
     '''Internal class, holds the information associated to each matcher'''
         
+    #kinds of definition, as resolved by the compiled names
+    FLAG, OPTION, PREFIX = range(1, 4)
+    NOT_FOUND = None, None
+    
     DECORATOR_ASSIGN = re.compile('(.+?)\\s+as\\s+(.+)')
     FLAG_PATTERN = re.compile('(.+)' + 
                               '(Flag|Option|OptionInt|OptionFloat|Prefix)$')
@@ -371,7 +579,23 @@ class OptMatcherInfo(object):
                     raise OptionMatcherException('Repeated option "' + name + 
                                                  '" in ' + self.describe())
                 defSet.add(name)
+        self._compileNames()
                 
+    def _compileNames(self):
+        #Maps each long and short name to its (kind, index) target, so
+        # an argument is resolved with a single lookup. The long names are
+        # also kept in a trie, to split prefixes and to expand abbreviations
+        self.longNames, self.shortNames, self.names = {}, {}, NameTrie()
+        for kind, group in ((self.FLAG, self.flags), 
+                            (self.OPTION, self.options),
+                            (self.PREFIX, self.prefixes)):
+            for name, index in group.items():
+                if name in self.defs:
+                    self.longNames[name] = kind, index
+                    self.names.add(name, (kind, index))
+                if name in self.shortDefs:
+                    self.shortNames[name] = kind, index
+        
     def _getDefsGroup(self, name):
         if len(name) == 1:
             #note that, in non getopt mode, shortDefs points to defs
@@ -389,6 +613,7 @@ class OptMatcherInfo(object):
         self.pars = {}       #maps parameter index to parameter name
         self.lastArg = 1     #the last available variable index plus 1
         self.orphanFlags = 0 #flags without associated variable        
+        self.stream = None   #index of the <name>Stream parameter, if any
         self.func = func
         
         vars, self.vararg, kwarg = self._getParametersInfo(func)
@@ -434,6 +659,10 @@ class OptMatcherInfo(object):
                         self.converts[self.lastArg] = self._asInt
                     elif what == 'OptionFloat':
                         self.converts[self.lastArg] = self._asFloat
+            elif (var.endswith('Stream') and var == vars[-1] and 
+                    not self.vararg):
+                #receives the remaining parameters, as an iterator
+                self.stream = self.lastArg
             else:
                 self.pars[self.lastArg] = var
             self.lastArg += 1        
@@ -513,8 +742,8 @@ class OptMatcherInfo(object):
         return self.group.match(matcherHandler.func.__name__) != None
             
     def supportVargs(self):
-        '''Returns whether it accepts *vars'''
-        return self.vararg > 0
+        '''Returns whether it accepts *vars (or a <name>Stream parameter)'''
+        return self.vararg > 0 or self.stream is not None
     
     def supportsKWArgs(self):
         '''Returns whether it accepts **kargs argument'''
@@ -588,6 +817,7 @@ class OptMatcherInfo(object):
                         raise OptionMatcherException (new + ' cannot be a '
                                         'public rename, already defined as ' + 
                                         'parameter in ' + self.describe())
+        self._compileNames()
                                             
     def setAliases(self, aliases):
         '''Sets aliases between option definitions.'''
@@ -627,6 +857,7 @@ class OptMatcherInfo(object):
                 #if alias 'l' is already known, we try setting from s->l
                 s, l = l, s
             setAlias(s, l, self.shortDefs, self.defs)
+        self._compileNames()
             
     def getIndexName(self, index):
         #returns the flag/option/parameter name with the given index 
@@ -670,14 +901,29 @@ class OptMatcherHandler(OptMatcherInfo):
     It is an OptMatcherInfo extended with operations to handle arguments
     ''' 
         
-    def __init__(self, func, mode):
-        OptMatcherInfo.__init__(self, func, mode)
+    def __init__(self, info, func, mode):
+        #the compiled information is shared with every other handler created
+        #from the same OptMatcherInfo, and never modified: it is read from
+        #info. Only the function to invoke, the mode and the per run state
+        #belong to this handler
+        self.info, self.func, self.mode = info, func, mode
+        self.kwargs = isinstance(info.kwargs, dict) and {}
         self.reset()
         
+    def __getattr__(self, name):
+        #the compiled information not read directly from info
+        return getattr(self.info, name)
+        
+    def copy(self):
+        '''Returns a new handler for the same function, with no state'''
+        return OptMatcherHandler(self.info, self.func, self.mode)
+        
     def reset(self):
         #all prefixes are reset as provided as an empty list
-        self.provided = dict([(i, []) for i in self.prefixes.values()])
+        self.provided = dict([(i, []) for i in self.info.prefixes.values()])
         self.providedPars = []
+        #the parameters for the stream are kept as ranges of argument indexes
+        self.streamed, self.streamSource = [], None
                 
     def invoke(self):
         '''Invokes the underlying function, unless it cannot be invoked.'''
@@ -690,8 +936,8 @@ class OptMatcherHandler(OptMatcherInfo):
         
         def somethingProvided():
             #just check if the user provided any value.
-            return self.providedPars or filter(lambda x: x != [],
-                                               self.provided.values())            
+            return (self.providedPars or self.streamed or 
+                    filter(lambda x: x != [], self.provided.values()))            
         #It can, if all the options/parameters are specified or have defaults
         errorReason = self._getInvokingPars()[0]        
         return (required or somethingProvided()) and errorReason
@@ -699,22 +945,26 @@ class OptMatcherHandler(OptMatcherInfo):
     def _getInvokingPars(self):
         #Returns the parameters required to invoke the underlying function.
         #It returns a tuple (problem, *args, **kwargs)
+        info = self.info
         provided = self.provided or self.providedPars
         args, parameters = [], self.providedPars[:]
         #we only check the indexes 1...lastArg, so the orphan flags are not
         #checked here (they are not used to invoke the method)
-        for i in range(1, self.lastArg):
+        for i in range(1, info.lastArg):
+            if i == info.stream:
+                args.append(self._getStream())
+                continue
             try:
                 value = self.provided[i] #read first the provided value
             except KeyError:
                 #otherwise, the current index could refer to a parameter,
                 #which are stored separately
-                if i in self.pars and parameters:
+                if i in info.pars and parameters:
                     value = parameters.pop(0) 
                 else:
                     #this argument were not provided: try the default value
                     try:
-                        value = self.defaults[i]
+                        value = info.defaults[i]
                     except KeyError:
                         #Neither, this function cannot be invoked
                         return ('Missing required ' + self.getIndexName(i),
@@ -726,11 +976,28 @@ class OptMatcherHandler(OptMatcherInfo):
         #It must be still checked the orphan flags' variables
         #These are not passed to the method, but must have been provided to 
         #consider that the method can be invoked
-        for c in range(self.orphanFlags, 0):
+        for c in range(info.orphanFlags, 0):
             if not c in self.provided:
                 return 'Missing required ' + self.getIndexName(c), None, None
             
         return None, args, self.kwargs or {}
+    
+    def _getStream(self):
+        #Returns an iterator over the parameters given to the stream,
+        # reading the command line -and its argument files- again
+        ranges, source = self.streamed, self.streamSource
+        def values():
+            pending = iter(ranges)
+            start, end = pending.next()
+            for index, arg in enumerate(source.iterate()):
+                if index >= end:
+                    try:
+                        start, end = pending.next()
+                    except StopIteration:
+                        return
+                if index >= start:
+                    yield arg
+        return ranges and values() or iter(())
                         
     def handleArg(self, commandLine):
         '''Handles one argument in the command line'''
@@ -748,10 +1015,18 @@ class OptMatcherHandler(OptMatcherInfo):
                 return self._handleShortArg(commandLine)
             return self._handleLongArg(commandLine)
         #If not, it is a parameter, but perhaps there are already too many...
-        if not self.vararg and (len(self.providedPars) >= len(self.pars)):
+        info = self.info
+        if info.vararg or (len(self.providedPars) < len(info.pars)):
+            self.providedPars.append(commandLine.arg)
+        elif info.stream:
+            index = commandLine.getIndex()
+            if self.streamed and self.streamed[-1][1] == index:
+                self.streamed[-1][1] = index + 1
+            else:
+                self.streamed.append([index, index + 1])
+            self.streamSource = commandLine.tokens
+        else:
             return 'Unexpected argument: ' + commandLine.arg
-         
-        self.providedPars.append(commandLine.arg)
         commandLine.setArgHandled()
         return None
     
@@ -759,17 +1034,18 @@ class OptMatcherHandler(OptMatcherInfo):
         '''Handles one long argument in the command line.'''
         name = cmd.name
         #only check the name if defined (and not defined as a short option)
-        okName = name in self.defs
-        if okName and self._handleOption(cmd):
+        kind, index = self.info.longNames.get(name, self.NOT_FOUND)
+        if kind == self.OPTION:
+            self._handleOption(cmd, index)
             return None
         
-        flag = okName and self.flags.get(name, None)
-        if flag:
+        if kind == self.FLAG:
             if cmd.split: #flag, but user specified a value
                 raise UsageException('Incorrect flag ' + name)
-            self.provided[flag] = True
+            self.provided[index] = True
         else:
-            prefix, name = self._splitPrefix(name)
+            #the name can still start with a prefix (not a short one)
+            prefix, name = self.info.names.splitPrefix(name, self.PREFIX)
             if prefix:
                 if not name:
                     #perhaps is given as -D=value(bad) or separate (getopt)
@@ -792,70 +1068,145 @@ class OptMatcherHandler(OptMatcherInfo):
         '''Handles one short argument in the command line'''
         #This method is only called for getopt mode
         name = cmd.name
-        if not name in self.shortDefs:
+        kind, index = self.info.shortNames.get(name, self.NOT_FOUND)
+        if not kind:
             #in shorts, name is just one letter, so not inclusion in 
             #shortDefs means that it is neither a prefix, do no more checks
             return 'Unexpected flag ' + name + ' in argument ' + cmd.arg
-        flag = self.flags.get(name, None)
-        if flag:
-            self.provided[flag] = True
+        if kind == self.FLAG:
+            self.provided[index] = True
             cmd.setShortArgHandled()
-        elif not self._handleOption(cmd):
-            prefix = self.prefixes.get(name, None)
+        elif kind == self.OPTION:
+            self._handleOption(cmd, index)
+        else:
             #no flag, no option, but in shortDefs->is a prefix! 
             if not cmd.value:
                 #given separately                    
                 if cmd.setArgHandled():
                     raise UsageException('Incorrect prefix ' + name)
                 cmd.value = cmd.arg
-            self.provided[prefix].append(cmd.separate(cmd.value)[1:])
+            self.provided[index].append(cmd.separate(cmd.value)[1:])
             cmd.setArgHandled()            
         return None
                 
-    def _handleOption(self, cmd):
-        '''Checks if the command is a valid option, handling it if so
-           Returns the option handled, or None if not handled
-        '''
+    def _handleOption(self, cmd, option):
+        '''Handles the command as the option with the given index'''
         #the normal case, -name=value, implies command.value
         name = cmd.name
-        option = self.options.get(name, None)
-        if option:
-            if cmd.value:
-                value = cmd.value
-            else:
-                #under getoptmode, this is still valid if the value is
-                #provided as a separate argument (no option, no split)
-                if not self.mode.getopt or cmd.setArgHandled() or cmd.split:
-                    raise UsageException('Incorrect option ' + name)
-                value = cmd.arg
-            #If a conversion is needed (to integer/float), do it now
-            try:
-                value = self.converts[option](value)
-            except KeyError:
-                #no conversion required, we treat it always as file
-                value = os.path.expanduser(os.path.expandvars(value))
-            except ValueError:
-                raise UsageException('Incorrect value for ' + name)
-            self.provided[option] = value
-            cmd.setArgHandled()
-        return option
+        if cmd.value:
+            value = cmd.value
+        else:
+            #under getoptmode, this is still valid if the value is
+            #provided as a separate argument (no option, no split)
+            if not self.mode.getopt or cmd.setArgHandled() or cmd.split:
+                raise UsageException('Incorrect option ' + name)
+            value = cmd.arg
+        #If a conversion is needed (to integer/float), do it now
+        try:
+            value = self.info.converts[option](value)
+        except KeyError:
+            #no conversion required, we treat it always as file
+            value = os.path.expanduser(os.path.expandvars(value))
+        except ValueError:
+            raise UsageException('Incorrect value for ' + name)
+        self.provided[option] = value
+        cmd.setArgHandled()
     
-    def _splitPrefix(self, name):
-        #Splits an existing prefix from the given name.
-        #   It does not apply to short prefixes (getopt mode)
-        #   It returns the tuple (prefix, rest), or (None, None) if not found
-        for each in self.prefixes:
-            if each in self.defs and name.startswith(each):
-                return self.prefixes[each], name[len(each):]
-        return None, None
+    def acceptsLongName(self, name):
+        '''Returns True if the long option name would be handled as is, 
+        without expanding it as an abbreviation'''
+        return (name in self.longNames or isinstance(self.kwargs, dict) or
+                self.names.splitPrefix(name, self.PREFIX)[0] is not None)
                             
         
+class MatchCandidate(object):
+    '''Internal class, a matcher and its common handlers being tried against
+    the command line. Each candidate has its own position in the command 
+    line, so all of them can be tried side by side, argument by argument.
+    '''
+    #Available instance attributes:
+    #   problem  : the reason why the handlers cannot process the command 
+    #              line, or None
+    #   position : the command line position where the problem was found
+    #   error    : the exc_info of an exception raised while handling the
+    #              command line, if any
+    #   done     : True once the candidate has succeeded or failed
+    
+    def __init__(self, handler, commonHandlers, commandLine, 
+                 abbreviations=None):
+        self.handler = handler
+        self.commonHandlers = commonHandlers
+        self.handlers = [handler] + commonHandlers
+        self.commandLine = commandLine
+        self.abbreviations = abbreviations
+        self.problem, self.position, self.error = None, None, None
+        self.done = False
+        
+    def step(self):
+        '''Handles the next argument, returning False once done'''
+        try:
+            if self.commandLine.finished():
+                self.problem = self._checkInvokable()
+            else:
+                if (self.abbreviations and self.commandLine.option and 
+                        not self.commandLine.isShort):
+                    self._expandAbbreviation(self.commandLine)
+                for each in self.handlers:
+                    problem = each.handleArg(self.commandLine)
+                    if not problem:
+                        return True
+                self.problem = problem
+        except:
+            import sys
+            self.error = sys.exc_info()
+        if self.problem:
+            self.position = self.commandLine.getPosition()
+        self.commandLine.close()
+        self.done = True
+        return False
+        
+    def invoke(self):
+        '''Invokes the common handlers, then the matcher's handler'''
+        for each in self.commonHandlers:
+            each.invoke()
+        return self.handler.invoke()
+            
+    def _expandAbbreviation(self, cmd):
+        #An unknown long option name is replaced with the name it abbreviates,
+        # if there is only one among all the handlers in self.abbreviations
+        # -not just those of this candidate-. Names in different handlers
+        # are ambiguous, unless they are the same, as are the aliases of 
+        # one option
+        for each in self.handlers:
+            if each.acceptsLongName(cmd.name):
+                return
+        names, targets = set(), set()
+        for each in self.abbreviations:
+            for name, target in each.names.complete(cmd.name):
+                names.add(name)
+                targets.add((each, target))
+        if len(names) == 1 or len(targets) == 1:
+            cmd.name = names.pop()
+            
+    def _checkInvokable(self):
+        for each in self.commonHandlers:
+            problem = each.checkInvokable(False)
+            if problem:
+                return problem
+        return self.handler.checkInvokable(True)
+        
+
 class UsageAccessor(object):
     '''Class to access and to format usage info'''
     
     def __init__(self, handlers, mode):
         self.mode = mode
         self.handlers = handlers #each is a list [matcher, optsets...]
+        #the usage strings and the content of each alternative are formatted
+        # once, on demand: a new UsageAccessor is created when the
+        # information they depend on changes
+        self.usageStrings = {}
+        self.alternativesContent = {}
         self.reset()
         
     def getContent(self):
@@ -915,6 +1266,11 @@ class UsageAccessor(object):
         output is limited to 72 characters, with information for each option
         positioned on the column 24.
         '''
+        key = width, column, ident, includeUsage, includeAlternatives
+        try:
+            return self.usageStrings[key]
+        except KeyError:
+            pass
         self.reset(width)
         if not self.handlers:
             self.add('Error, no usage configured')
@@ -947,7 +1303,7 @@ class UsageAccessor(object):
                 self.addLine()
                 self.addLine('alternatives:')
                 for i in range(alternatives):
-                    content = self.getOptions(i) + self.getParameters(i)
+                    content = self._getAlternativeContent(i)
                     self.addLine()
                     self.addLine('*')
                     self.add(content, ident)
@@ -957,7 +1313,18 @@ class UsageAccessor(object):
                         for line in doc.split('\n'):
                             if line.strip():
                                 self.add(line, column)
-        return self.getContent()
+        ret = self.usageStrings[key] = self.getContent()
+        return ret
+    
+    def _getAlternativeContent(self, alternative):
+        #returns the options and parameters of the given matcher, computed
+        # once for all the usage strings
+        try:
+            return self.alternativesContent[alternative]
+        except KeyError:
+            ret = self.getOptions(alternative) + self.getParameters(alternative)
+            self.alternativesContent[alternative] = ret
+            return ret
         
     def getAlternatives(self):
         '''Returns the number of provided matchers'''
@@ -1054,9 +1421,13 @@ class OptionMatcher (object):
     It supports naturally the handling of mutually exclusive options.
     '''
     
+    #how many compiled handler tables, one per configuration, each class
+    #keeps; see _getHandlerTable
+    HANDLER_TABLES = 4
+
     def __init__(self, aliases=None, publicNames=None, optionsHelp=None,
                  optionVarNames=None, optionPrefix='--', assigner='=',
-                 defaultHelp=True):
+                 defaultHelp=True, abbreviations=False, argumentFiles=False):
         '''
         Param aliases is a map, allowing setting option aliases. 
             In getopt mode, all aliases must be defined between a short
@@ -1092,9 +1463,19 @@ class OptionMatcher (object):
             and value
         Param defaultHelp is True to automatically show the usage when the
             user requests the --help option (or -h)
+        Param abbreviations is True to accept any unambiguous abbreviation
+            of a long option name, like --verb for --verbose
+        Param argumentFiles is True to read the arguments in @file arguments.
+            Each line in the file is an argument; the file is read as the 
+            command line is processed. A last parameter named <name>Stream
+            receives the remaining parameters as an iterator, so they are 
+            not kept in memory
         '''
         self._mode = UsageMode(optionPrefix, assigner)
+        self._usage = None
         self.enableDefaultHelp(defaultHelp)
+        self.enableAbbreviations(abbreviations)
+        self.enableArgumentFiles(argumentFiles)
         self.setAliases(aliases)
         self.setPublicNames(publicNames)
         self.setUsageInfo(optionsHelp, optionVarNames)
@@ -1102,29 +1483,46 @@ class OptionMatcher (object):
     def enableDefaultHelp(self, set=True):
         '''Enables the default help, under 'h' or 'help' '''
         self._defaultHelp = set
+        self._usage = None
+        
+    def enableAbbreviations(self, set=True):
+        '''Enables abbreviated long option names. See __init__'''
+        self._abbreviations = set
+        
+    def enableArgumentFiles(self, set=True):
+        '''Enables reading arguments from @file arguments. See __init__'''
+        self._argumentFiles = set
         
     def setAliases(self, aliases):
         '''Sets the aliases. See __init__'''
         self._aliases = aliases
+        self._usage = None
     
     def setPublicNames(self, publicNames):
         '''Sets the public names. See __init__'''
         self._publicNames = publicNames
+        self._usage = None
     
     def setUsageInfo(self, optionsHelp, optionVarNames):
         '''Sets the usage information for each option. See __init__'''
         self._mode.set(optionsHelp=optionsHelp, varNames=optionVarNames)
+        self._usage = None
     
     def setMode(self, optionPrefix, assigner):
         '''Sets the working mode. See __init__'''
         self._mode.set(option=optionPrefix, assigner=assigner)
+        self._usage = None
     
     def getUsage(self):
         '''Returns an Usage object to handle the usage info'''
-        matcherHandlers, commonHandlers = self._createHandlers()
-        handlers = [[m] + filter(lambda x: x.appliesToMatcher(m),
-                                 commonHandlers) for m in matcherHandlers]
-        return UsageAccessor(handlers, self._mode)
+        #it is kept, with the usage strings it formats, until the options or
+        # their usage information change
+        if not self._usage:
+            matcherHandlers, commonHandlers = self._createHandlers()
+            handlers = [[m] + filter(lambda x: x.appliesToMatcher(m),
+                                     commonHandlers) for m in matcherHandlers]
+            self._usage = UsageAccessor(handlers, self._mode)
+        return self._usage
     
     def printHelp(self):
         '''shows the help message'''
@@ -1138,32 +1536,11 @@ class OptionMatcher (object):
             UsageExceptions, returning the value handleUsageProblems
         '''
         matchers, commons = self._createHandlers()   
-        commandLine = CommandLine(args, self._mode, gnu)        
-        highestProblem = (-1, 0), 'Invalid command line input'
+        commandLine = CommandLine(args, self._mode, gnu, 
+                                  argumentFiles=self._argumentFiles)        
         
-        #the method is simple: for each matcher, we verify if the arguments
-        # suit it, taking in consideration the common handler, if given.
-        #As soon as a matcher can handle the arguments, we invoke it, as well
-        # as the common handler, if given.
         try:
-            for handler in matchers:
-                #only use the common handlers that apply to the matcher
-                assocCommons = filter(lambda x: x.appliesToMatcher(handler),
-                                      commons)
-                problem = self._tryHandlers(assocCommons, handler, commandLine)
-                if not problem:
-                    #handlers ok: invoke common handler, then matcher's handler
-                    for each in assocCommons:
-                        each.invoke()
-                    return handler.invoke()
-                position = commandLine.getPosition()
-                if position > highestProblem[0]:
-                    highestProblem = position, problem 
-                #prepare command line, common handlers for next loop
-                commandLine.reset()
-                for each in commons:
-                    each.reset()
-            raise UsageException (highestProblem[1])       
+            return self._match(matchers, commons, commandLine).invoke()
         except UsageException, ex:
             if handleUsageProblems != False:
                 import sys
@@ -1176,16 +1553,6 @@ class OptionMatcher (object):
         #Returns all the required handlers, as a tuple
         #the first element is the list of matchers, and the second, the
         #common matcher
-        def createHandle(function):
-            if not function:
-                return None
-            ret = OptMatcherHandler(function, self._mode)
-            if self._publicNames:
-                ret.setPublicNames(self._publicNames)                
-            if self._aliases:
-                ret.setAliases(self._aliases)                
-            return ret
-        
         if self._defaultHelp:
             if self._mode.getopt:
                 self._aliases = self._aliases or {}
@@ -1193,43 +1560,145 @@ class OptionMatcher (object):
             self._mode.optionsHelp = self._mode.optionsHelp or {}
             self._mode.optionsHelp['help'] = 'shows this help message'
 
-        matchers = [createHandle(f) 
-                    for f in Decoration.getDecoratedMethods(self, False)]
+        def createHandle(entry):
+            name, info = entry
+            if name:
+                func = getattr(self, name)
+            else:
+                func = self._getHelpFunction()
+            return OptMatcherHandler(info, func, self._mode)
+
+        matchersInfo, commonsInfo = self._getHandlerTable()
+        return map(createHandle, matchersInfo), map(createHandle, commonsInfo)
+
+    def _getHandlerTable(self):
+        #Returns the compiled (name, OptMatcherInfo) lists for the matchers
+        # and the common handlers. Compiling introspects every decorated
+        # method, so it is done once per class and configuration: changing
+        # the aliases, public names or mode just selects another table.
+        #The tables are kept in the class itself -not shared with its base
+        # classes-, for its last HANDLER_TABLES configurations
+        def freeze(d):
+            return d and tuple(sorted(d.items()))
+        key = (self._defaultHelp, self._mode.option, self._mode.assigner, 
+               freeze(self._aliases), freeze(self._publicNames))
+        tables = self.__class__.__dict__.get('_handlerTables')
+        if tables is None:
+            tables = self.__class__._handlerTables = []
+        for tableKey, table in tables:
+            if tableKey == key:
+                return table
+
+        def createInfo(function):
+            ret = OptMatcherInfo(function, self._mode)
+            if self._publicNames:
+                ret.setPublicNames(self._publicNames)                
+            if self._aliases:
+                ret.setAliases(self._aliases)                
+            #the function is bound to this instance: each handler gets its own
+            ret.func = None
+            return ret
+
+        matchers = [(name, createInfo(f)) 
+                    for name, f in Decoration.getDecoratedMethods(self, False)]
         
         if not matchers:
             raise OptionMatcherException("No matchers defined")
         
-        commons = [createHandle(f) 
-                    for f in Decoration.getDecoratedMethods(self, True)]
+        commons = [(name, createInfo(f)) 
+                    for name, f in Decoration.getDecoratedMethods(self, True)]
         
         if self._defaultHelp:
-            #cannot decorate directly printHelp, any instance would
-            #get the decoration!
-            f = lambda : self.printHelp()
-            f.__doc__ = self.printHelp.__doc__
-            matchers.append(createHandle(optmatcher(
-                                         flags='help', exclusive=True)(f)))
+            matchers.append((None, createInfo(self._getHelpFunction())))
 
+        tables.insert(0, (key, (matchers, commons)))
+        del tables[self.HANDLER_TABLES:]
         return matchers, commons
+
+    def _getHelpFunction(self):
+        #cannot decorate directly printHelp, any instance would
+        #get the decoration!
+        f = lambda : self.printHelp()
+        f.__doc__ = self.printHelp.__doc__
+        return optmatcher(flags='help', exclusive=True)(f)
     
-    def _tryHandlers(self, commonHandlers, commandHandler, commandLine):
-        #Checks if the specified handlers can process the command line.
-        #If so, it returns None, letting the handlers ready to be invoked
-        #Otherwise, it returns the reason why it cannot be handled
-        handlers = [commandHandler] + commonHandlers
-        while not commandLine.finished():
-            for each in handlers:
-                problem = each.handleArg(commandLine)
-                if not problem:
-                    break
-            else:
-                if problem:
-                    return problem
-        for each in commonHandlers:
-            problem = each.checkInvokable(False)
-            if problem:
-                return problem
-        return commandHandler.checkInvokable(True)
+    def _match(self, matchers, commons, commandLine):
+        #Returns the MatchCandidate to invoke for the command line, or raises
+        # the UsageException for the problem found furthest in it.
+        #Each matcher is tried with the common handlers that apply to it. The
+        # first one in priority order is chosen among those that can handle
+        # the whole command line, unless a matcher before it fails with an
+        # exception.
+        abbreviations = self._abbreviations and matchers + commons
+        def candidate(handler, canBeOption=True):
+            return MatchCandidate(handler, 
+                                  [each.copy() for each in commons 
+                                   if each.appliesToMatcher(handler)],
+                                  commandLine.copy(canBeOption), abbreviations)
+        try:
+            if commandLine.tokens.gnuMode:
+                return self._matchInTurn(matchers, candidate)
+            return self._matchSideBySide(matchers, candidate)
+        finally:
+            commandLine.close()
+        
+    def _matchInTurn(self, matchers, candidate):
+        #Under gnu mode, each matcher reads the command line as the previous 
+        # one left it: once a matcher has read a non option argument, the 
+        # ones after it cannot start with an option. So they are tried one 
+        # after another, as the original optmatch does
+        failed, canBeOption = [], True
+        for handler in matchers:
+            each = candidate(handler, canBeOption)
+            while each.step():
+                pass
+            if not each.problem:
+                return self._chosen(each)
+            failed.append(each)
+            canBeOption = each.commandLine.canBeOption
+        raise self._furthestProblem(failed)
+            
+    def _matchSideBySide(self, matchers, candidate):
+        #The matchers are tried side by side in a single pass over the 
+        # command line, each being dropped as soon as it fails. Once any 
+        # matcher has succeeded or raised, the ones after it are not tried
+        # any further. Matchers accepting the same arguments still handle
+        # each of them, so the worst case remains matchers x arguments.
+        candidates = map(candidate, matchers)
+        running, first, settled = list(enumerate(candidates)), 0, len(candidates)
+        while True:
+            while first < settled and candidates[first].problem:
+                first += 1
+            if first == settled:
+                break
+            stepping, running = running, []
+            for index, each in stepping:
+                if index < settled:
+                    if each.step():
+                        running.append((index, each))
+                    elif not each.problem:
+                        settled = index
+                else:
+                    each.commandLine.close()
+        
+        if settled < len(candidates):
+            return self._chosen(candidates[settled])
+        raise self._furthestProblem(candidates)
+    
+    def _chosen(self, candidate):
+        #Returns the candidate, unless it failed with an exception: raised
+        if candidate.error:
+            raise candidate.error[0], candidate.error[1], candidate.error[2]
+        return candidate
+    
+    def _furthestProblem(self, candidates):
+        #Returns the UsageException for the problem found furthest in the 
+        # command line by the given failed candidates
+        highestProblem = (-1, 0), 'Invalid command line input'
+        for failed in candidates:
+            if failed.position > highestProblem[0]:
+                highestProblem = failed.position, failed.problem
+        return UsageException (highestProblem[1])
         
 
 class OptionMatcherException(Exception):
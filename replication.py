@@ -0,0 +1,363 @@
+'''replication - pull builds from a leader ICBM node
+
+The leader describes every app as a set of files with their sizes and
+sha256 digests (see describe_app). A Follower compares that against its
+local tree and, for each app whose build hash differs, assembles the new
+build in a private directory: files it already has with the right digest are
+hard linked (or copied), the rest are downloaded with resumable ranged
+requests and verified. The app name is then switched to the new build by
+atomically renaming a symlink over it, so readers see either the old build
+or the new one, never a mix.
+
+Nothing the leader sends is trusted as a path: app and file names must be
+single, non-hidden path components, and only the files an app is made of
+(ipa, plists and icons) are replicated.
+'''
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import urllib
+import urllib2
+
+BUILDS_DIR = '.icbm-builds'
+STAGING_DIR = '.icbm-staging'
+CHUNK_SIZE = 256*1024
+KEEP_BUILDS = 2
+# seconds to wait on the leader before giving up on a request
+TIMEOUT = 60
+# the files replicated, by extension
+APP_FILES = ('.ipa', '.plist', '.png')
+
+_SHA256 = re.compile('^[0-9a-f]{64}$')
+
+class HashCache(object):
+    '''sha256 digests of files, recomputed only when size or mtime change'''
+    def __init__(self):
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def digest(self, path):
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime)
+        with self._lock:
+            cached = self._digests.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        digest = file_digest(path)
+        with self._lock:
+            self._digests[path] = (key, digest)
+        return digest
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def build_hash(files):
+    '''Hash identifying a build by its file names and contents'''
+    h = hashlib.sha256()
+    for fname in sorted(files):
+        h.update('%s\0%s\n' % (fname, files[fname]['sha256']))
+    return h.hexdigest()
+
+def describe_app(path, hashes):
+    '''Returns {'build':..., 'files':{fname:{'size':..., 'sha256':...}}}
+    for the regular, non-hidden files at the top of an app directory'''
+    files = {}
+    for fname in os.listdir(path):
+        fpath = os.path.join(path, fname)
+        if fname.startswith('.') or not os.path.isfile(fpath):
+            continue
+        files[fname] = {'size':os.path.getsize(fpath),
+                        'sha256':hashes.digest(fpath)}
+    return {'build':build_hash(files), 'files':files}
+
+
+class ReplicaIndex(object):
+    '''The descriptions of the local apps that a leader serves to its
+    followers. Apps are described by a background thread as they are
+    published, so serving the index never reads a file.'''
+    def __init__(self, locate, hashes=None):
+        '''
+        Param locate(name) returns where an app lives, or None if it is
+            kept by another node.
+        '''
+        self.locate = locate
+        self.hashes = hashes or HashCache()
+        self.apps = {}
+        # set once the apps there were at start have been described
+        self.ready = threading.Event()
+        self._pending = set()
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+
+    def start(self, names):
+        '''Describes the apps names() lists, then any passed to update(), in
+        a background thread'''
+        with self._cond:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, args=(names,))
+            self._thread.setDaemon(True)
+        self._thread.start()
+
+    def update(self, names, removed=()):
+        '''Queues apps to be described again and forgets removed ones'''
+        with self._cond:
+            for name in removed:
+                self._pending.discard(name)
+                self.apps.pop(name, None)
+            self._pending.update(names)
+            self._cond.notify()
+
+    def _run(self, names):
+        self.update(names())
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self.ready.set()
+                    self._cond.wait()
+                name = self._pending.pop()
+            try:
+                path = self.locate(name)
+                desc = path and describe_app(path, self.hashes)
+            except Exception, ex:
+                # removed since, unreadable or timed out; described again
+                # when the catalog next sees it change
+                print 'could not describe', name, ex
+                desc = None
+            with self._cond:
+                if desc:
+                    self.apps[name] = desc
+                else:
+                    self.apps.pop(name, None)
+
+    def snapshot(self):
+        with self._cond:
+            return dict(self.apps)
+
+
+class ReplicationError(Exception):
+    pass
+
+
+def safe_name(name):
+    '''Whether name is a single, non-hidden path component'''
+    return bool(name) and not name.startswith('.') and not os.path.isabs(name) \
+        and '/' not in name and os.sep not in name and '\0' not in name \
+        and not (os.altsep and os.altsep in name)
+
+def _checked(name, desc):
+    # the leader's description of an app limited to its app files, with the
+    # build hash recomputed over those. Raises ReplicationError if a name
+    # could lead outside the app directory or a digest or size is invalid.
+    if not isinstance(desc, dict) or not isinstance(desc.get('files'), dict):
+        raise ReplicationError('%s: bad description' % name)
+    files = {}
+    for fname, info in desc['files'].items():
+        fname = fname.encode('utf-8')
+        if not safe_name(fname):
+            raise ReplicationError('%s: unsafe file name %r' % (name, fname))
+        if not isinstance(info, dict):
+            raise ReplicationError('%s: bad description of %s' % (name, fname))
+        sha256, size = info.get('sha256'), info.get('size')
+        if not isinstance(sha256, basestring) or not _SHA256.match(sha256) \
+                or not isinstance(size, (int, long)) or size < 0:
+            raise ReplicationError('%s: bad description of %s' % (name, fname))
+        files[fname] = {'size':size, 'sha256':str(sha256)}
+    return _app_description(files)
+
+def _app_description(files):
+    # builds are compared by their app files alone
+    files = dict((fname, info) for fname, info in files.items()
+                 if os.path.splitext(fname)[1].lower() in APP_FILES)
+    return {'build':build_hash(files), 'files':files}
+
+
+class Follower(object):
+    def __init__(self, leader_url, root='.', prune=False, locate=None, names=None):
+        '''
+        Param locate(name) returns where an app lives (or is to be
+            published), by default directly in root, or None for apps kept
+            by another node, which are not replicated.
+        Param names() lists the local apps, used when pruning.
+        '''
+        self.leader_url = leader_url.rstrip('/')
+        self.root = root
+        self.prune = prune
+        self.locate = locate or (lambda name: os.path.join(root, name))
+        self.names = names or (lambda: [n for n in os.listdir(root) if not n.startswith('.')])
+        self.hashes = HashCache()
+        self.builds_dir = os.path.join(root, BUILDS_DIR)
+        self.staging_dir = os.path.join(root, STAGING_DIR)
+        self.last_sync = None
+        self.last_error = None
+        self._thread = None
+
+    def start(self, interval):
+        '''Syncs every interval seconds in a background thread'''
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, args=(interval,))
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _run(self, interval):
+        while True:
+            try:
+                self.sync()
+            except Exception, ex:
+                self.last_error = str(ex)
+                print 'replication from', self.leader_url, 'failed:', ex
+            time.sleep(interval)
+
+    def sync(self):
+        '''Pulls every app whose build differs from the leader's.
+        Returns the names of the apps that were published.'''
+        for d in self.builds_dir, self.staging_dir:
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+        remote = json.load(urllib2.urlopen(self.leader_url+'/_icbm/replica',
+                                           timeout=TIMEOUT))['apps']
+        published = []
+        # local names are the bytes os.listdir gives
+        remote = dict((name.encode('utf-8'), desc) for name, desc in remote.items())
+        for name, desc in sorted(remote.items()):
+            if not safe_name(name):
+                print 'not replicating', repr(name), 'unsafe app name'
+                continue
+            if self.locate(name) is None:
+                # lives in a storage root this node doesn't hold
+                continue
+            try:
+                desc = _checked(name, desc)
+                local = self._local(name)
+                if local and local['build'] == desc['build']:
+                    continue
+                self._pull(name, desc, local)
+            except Exception, ex:
+                # leave it for the next round, partial downloads are kept;
+                # one app failing doesn't hold up the others
+                print 'could not replicate', name, ex
+                continue
+            published.append(name)
+
+        if self.prune:
+            for name in self.names():
+                if name not in remote and self._local(name):
+                    self._unpublish(name)
+
+        self.last_sync = time.time()
+        self.last_error = None
+        return published
+
+    def _local(self, name):
+        path = self.locate(name)
+        if not path or not os.path.isdir(path):
+            return None
+        return _app_description(describe_app(path, self.hashes)['files'])
+
+    def _pull(self, name, desc, local):
+        build_dir = os.path.join(self.builds_dir, name, desc['build'][:16])
+        if not os.path.isdir(build_dir):
+            assembling = build_dir+'.tmp'
+            if os.path.isdir(assembling):
+                shutil.rmtree(assembling)
+            os.makedirs(assembling)
+
+            have = {}
+            if local:
+                for fname, info in local['files'].items():
+                    have[info['sha256']] = os.path.join(self.locate(name), fname)
+
+            for fname, info in desc['files'].items():
+                target = os.path.join(assembling, fname)
+                if info['sha256'] in have:
+                    _link_or_copy(have[info['sha256']], target)
+                else:
+                    os.rename(self._download(name, fname, info), target)
+
+            os.rename(assembling, build_dir)
+        self._publish(name, build_dir)
+
+    def _download(self, name, fname, info):
+        # downloads into the staging area, resuming from whatever an earlier
+        # attempt left behind, and returns the verified file's path
+        part = os.path.join(self.staging_dir, '%s.part' % info['sha256'])
+        offset = os.path.exists(part) and os.path.getsize(part) or 0
+        if offset > info['size']:
+            os.remove(part)
+            offset = 0
+
+        if offset < info['size']:
+            url = '%s/%s/%s' % (self.leader_url, urllib.quote(name), urllib.quote(fname))
+            req = urllib2.Request(url)
+            if offset:
+                req.add_header('Range', 'bytes=%d-' % offset)
+            resp = urllib2.urlopen(req, timeout=TIMEOUT)
+            if offset and resp.getcode() != 206:
+                # the leader ignored the range, start over
+                offset = 0
+            with open(part, offset and 'ab' or 'wb') as f:
+                for chunk in iter(lambda: resp.read(CHUNK_SIZE), ''):
+                    f.write(chunk)
+
+        if file_digest(part) != info['sha256']:
+            os.remove(part)
+            raise ReplicationError('%s/%s failed verification' % (name, fname))
+        return part
+
+    def _publish(self, name, build_dir):
+        link = self.locate(name)
+        parent = os.path.dirname(link)
+        tmp = os.path.join(parent, '.%s.tmp' % name)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(os.path.relpath(build_dir, parent), tmp)
+
+        if os.path.isdir(link) and not os.path.islink(link):
+            # first sync over a plain directory: it can't be swapped
+            # atomically, so move it aside into the builds first
+            os.rename(link, os.path.join(self.builds_dir, name, 'local-%d' % time.time()))
+        os.rename(tmp, link)
+        print 'published', name, 'from', self.leader_url
+        self._collect(name, os.path.basename(build_dir))
+
+    def _unpublish(self, name):
+        link = self.locate(name)
+        if os.path.islink(link):
+            os.remove(link)
+            self._collect(name, None)
+            print 'removed', name, 'no longer on', self.leader_url
+
+    def _collect(self, name, current):
+        # keep the newest KEEP_BUILDS builds so in-flight downloads of the
+        # previous build can finish
+        builds_dir = os.path.join(self.builds_dir, name)
+        builds = [b for b in os.listdir(builds_dir)
+                  if b != current and not b.endswith('.tmp')]
+        builds.sort(key=lambda b: os.path.getmtime(os.path.join(builds_dir, b)))
+        for b in builds[:max(0, len(builds)-KEEP_BUILDS+1)]:
+            shutil.rmtree(os.path.join(builds_dir, b))
+
+    def stats(self):
+        return {'leader':self.leader_url, 'last_sync':self.last_sync,
+                'last_error':self.last_error}
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(os.path.realpath(src), dst)
+    except OSError:
+        shutil.copy2(src, dst)
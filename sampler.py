@@ -0,0 +1,86 @@
+'''sampler - a sampling profiler for a running server
+
+A Sampler wakes up every `interval` seconds and records the stack of every
+other thread. The counts are reported in the collapsed format used by
+flame graph tools (one "thread;outer;...;inner count" line per stack), so a
+live server can be profiled without restarting it or slowing down every
+call the way a tracing profiler does.
+'''
+
+import collections
+import os
+import sys
+import threading
+import time
+
+def _label(frame):
+    code = frame.f_code
+    return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+
+class Sampler(object):
+    def __init__(self, interval=0.005, max_duration=300):
+        '''
+        Param interval is the time between samples, in seconds.
+        Param max_duration stops a forgotten sampler after that many seconds.
+        '''
+        self.interval = interval
+        self.max_duration = max_duration
+        self.samples = 0
+        self.started = None
+        self._counts = collections.defaultdict(int)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def start(self):
+        '''Starts sampling afresh; returns False if already running'''
+        with self._lock:
+            if self.running():
+                return False
+            self._counts.clear()
+            self.samples = 0
+            self.started = time.time()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def collapsed(self):
+        '''The stacks seen so far, in collapsed format'''
+        with self._lock:
+            counts = self._counts.items()
+        return ''.join('%s %d\n' % (stack, count) for stack, count in sorted(counts))
+
+    def _run(self):
+        me = threading.current_thread().ident
+        deadline = time.time() + self.max_duration
+        while not self._stop.is_set() and time.time() < deadline:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame:
+                    stack.append(_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread-%d' % ident))
+                stacks.append(';'.join(reversed(stack)))
+            with self._lock:
+                for stack in stacks:
+                    self._counts[stack] += 1
+                self.samples += 1
+            self._stop.wait(self.interval)
+
+    def stats(self):
+        return {'running':self.running(), 'samples':self.samples,
+                'started':self.started, 'interval':self.interval}
@@ -0,0 +1,186 @@
+'''scanner - concurrent, cached filesystem metadata lookups
+
+On network filesystems every stat and directory listing is a round trip.
+A Scanner runs them on a bounded pool of worker threads and caches the
+results for `ttl` seconds. Callers wait at most a per-call timeout: a lookup
+that takes longer raises ScanTimeout (the lookup carries on, and its result
+is cached for whoever asks next). Expired entries are served stale, up to
+`max_stale` seconds, while they are refreshed in the background, so a slow
+filer delays the refresh rather than the request.
+
+prefetch() starts lookups that are likely to be needed next without
+waiting for them.
+'''
+
+import errno
+import os
+import stat as stat_module
+import threading
+import time
+import Queue
+
+class ScanTimeout(Exception):
+    pass
+
+
+def _stat(path):
+    try:
+        return os.stat(path)
+    except OSError, ex:
+        if ex.errno in (errno.ENOENT, errno.ENOTDIR):
+            return None
+        raise
+
+def _subdirs(path):
+    names = []
+    for name in os.listdir(path):
+        if name.startswith('.'):
+            continue
+        st = _stat(os.path.join(path, name))
+        if st and stat_module.S_ISDIR(st.st_mode):
+            names.append(name)
+    return names
+
+OPERATIONS = {'stat':_stat, 'listdir':os.listdir, 'subdirs':_subdirs}
+
+
+class _Job(object):
+    def __init__(self, key):
+        self.key = key
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Scanner(object):
+    def __init__(self, workers=8, timeout=2.0, ttl=2.0, max_stale=30.0, max_entries=100000):
+        self.workers = workers
+        self.timeout = timeout
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.timeouts = 0
+        self._cache = {}
+        self._jobs = {}
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def stat(self, path, timeout=None):
+        '''os.stat(path), or None if path does not exist'''
+        return self._lookup('stat', path, timeout)
+
+    def isdir(self, path, timeout=None):
+        st = self.stat(path, timeout)
+        return bool(st and stat_module.S_ISDIR(st.st_mode))
+
+    def listdir(self, path, timeout=None):
+        return self._lookup('listdir', path, timeout)
+
+    def subdirs(self, path, timeout=None):
+        '''The non-hidden subdirectories of path'''
+        return self._lookup('subdirs', path, timeout)
+
+    def prefetch(self, op, paths):
+        '''Starts looking up op for each of paths, without waiting'''
+        now = time.time()
+        for path in paths:
+            cached = self._cache.get((op, path))
+            if not cached or cached[0] < now:
+                self._submit((op, path))
+
+    def map(self, op, paths, timeout=None):
+        '''Looks up op for all of paths concurrently, returning a dict of
+        path to result. Paths that fail or time out are left out.'''
+        self.prefetch(op, paths)
+        deadline = time.time() + (timeout or self.timeout)
+        results = {}
+        for path in paths:
+            try:
+                results[path] = self._lookup(op, path, max(0, deadline - time.time()))
+            except (ScanTimeout, OSError):
+                pass
+        return results
+
+    def invalidate(self, path):
+        with self._lock:
+            for op in OPERATIONS:
+                self._cache.pop((op, path), None)
+
+    def _lookup(self, op, path, timeout):
+        key = (op, path)
+        now = time.time()
+        cached = self._cache.get(key)
+        if cached:
+            expires, result, error = cached
+            if expires + self.max_stale >= now:
+                if expires < now:
+                    self._submit(key)
+                self.hits += 1
+                if error:
+                    raise error
+                return result
+
+        self.misses += 1
+        job = self._submit(key)
+        if timeout is None:
+            timeout = self.timeout
+        if not job.done.wait(timeout):
+            self.timeouts += 1
+            raise ScanTimeout('%s %s took longer than %.1fs' % (op, path, timeout))
+        if job.error:
+            raise job.error
+        return job.result
+
+    def _submit(self, key):
+        with self._lock:
+            job = self._jobs.get(key)
+            if job:
+                return job
+            job = self._jobs[key] = _Job(key)
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        self._queue.put(job)
+        return job
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            op, path = job.key
+            cache = True
+            try:
+                job.result = OPERATIONS[op](path)
+            except (OSError, IOError), ex:
+                job.error = ex
+            except Exception, ex:
+                # handed to the callers waiting now, but not cached
+                print 'scanner: %s %s failed: %r' % (op, path, ex)
+                job.error = ex
+                cache = False
+            finally:
+                # every job is resolved, or its key would be stuck
+                with self._lock:
+                    if cache:
+                        self._store(job.key, job.result, job.error)
+                    self._jobs.pop(job.key, None)
+                job.done.set()
+
+    def _store(self, key, result, error):
+        if len(self._cache) >= self.max_entries:
+            now = time.time()
+            for k, cached in self._cache.items():
+                if cached[0] + self.max_stale < now:
+                    del self._cache[k]
+            if len(self._cache) >= self.max_entries:
+                self._cache.clear()
+        self._cache[key] = (time.time() + self.ttl, result, error)
+
+    def stats(self):
+        return {'workers':len(self._threads), 'queued':self._queue.qsize(),
+                'cached':len(self._cache), 'hits':self.hits,
+                'misses':self.misses, 'timeouts':self.timeouts}
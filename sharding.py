@@ -0,0 +1,47 @@
+'''sharding - consistent-hash assignment of apps to storage roots
+
+Each root is placed on a hash ring at `replicas` points derived from its id,
+and an app belongs to the first root point at or after the hash of its name.
+Adding a root therefore only takes over the apps that hash next to its
+points; every other app stays where it is.
+'''
+
+import bisect
+import hashlib
+
+def _hash(key):
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+def is_remote(location):
+    return location.startswith('http://') or location.startswith('https://')
+
+
+class HashRing(object):
+    def __init__(self, roots, replicas=100):
+        '''
+        Param roots is a list of (root id, location) pairs. Ids place the
+            root on the ring and so must stay the same for as long as the
+            root exists; locations may differ between nodes.
+        '''
+        self.roots = dict(roots)
+        if len(self.roots) != len(roots):
+            raise ValueError('duplicate storage root id')
+        self._points = []
+        self._owners = []
+        for point, root_id in sorted((_hash('%s-%d' % (root_id, i)), root_id)
+                                     for root_id in self.roots
+                                     for i in range(replicas)):
+            self._points.append(point)
+            self._owners.append(root_id)
+
+    def owner(self, name):
+        '''Returns the id of the root the app belongs to'''
+        i = bisect.bisect_left(self._points, _hash(name))
+        return self._owners[i % len(self._owners)]
+
+    def location(self, name):
+        return self.roots[self.owner(name)]
+
+    def local_roots(self):
+        return [(root_id, location) for root_id, location in sorted(self.roots.items())
+                if not is_remote(location)]